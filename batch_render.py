@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Renders a folder of .md, .html and .tex documents to html with the pipeline of
+# the preview, without gedit nor GTK. Sources which haven't changed since the
+# last run are skipped, thanks to a manifest kept in the output folder.
+#
+# Usage: python3 batch_render.py SOURCE_DIR OUTPUT_DIR [--css style.css]
+#                                [--backend pandoc] [--jobs N] [--force]
+
+import argparse
+import json
+import os
+import sys
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'markdown_preview')
+sys.path.insert(0, PLUGIN_DIR)
+
+from pipeline.backends import BACKENDS
+from pipeline.batch import BatchRenderer
+
+def main():
+	parser = argparse.ArgumentParser(description='Render a folder of documents to html.')
+	parser.add_argument('source', help='folder of .md, .html and .tex documents')
+	parser.add_argument('output', help='folder where the html files are written')
+	parser.add_argument('--css', default=None, help='stylesheet linked by each page (path or url)')
+	parser.add_argument('--backend', default='pandoc', choices=sorted(BACKENDS), \
+		help='backend used for markdown when it supports the text (default: pandoc)')
+	parser.add_argument('--jobs', type=int, default=None, \
+		help='number of conversions at once (default: number of cores)')
+	parser.add_argument('--force', action='store_true', help='render unchanged sources too')
+	parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+	parser.add_argument('--quiet', action='store_true', help="don't list rendered files")
+	options = parser.parse_args()
+
+	if not os.path.isdir(options.source):
+		parser.error(options.source + ' is not a folder')
+	if os.path.abspath(options.source) == os.path.abspath(options.output):
+		parser.error('the output folder must not be the source folder')
+
+	def on_file_done(path, size, error):
+		if error is not None:
+			print(path + ': ' + error, file=sys.stderr)
+		elif size is not None and not options.quiet:
+			print(path)
+
+	renderer = BatchRenderer(options.source, options.output, options.backend, options.css, \
+		options.jobs, options.force)
+	summary = renderer.run(on_file_done)
+	if options.json:
+		print(json.dumps(summary, indent=2))
+	else:
+		print('%d rendered, %d skipped, %d failed, %d removed in %.2fs (%.1f files/s, %.2f MB/s)' % \
+			(summary['rendered'], summary['skipped'], summary['failed'], summary['removed'], \
+			summary['elapsed'], summary['files_per_second'], summary['megabytes_per_second']))
+	return 1 if summary['failed'] > 0 else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
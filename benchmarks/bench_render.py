@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# Headless benchmark of the preview render pipeline: no display, no Gedit, no
+# WebKit. A generated corpus goes through the same stages as on_reload (reading
+# the buffer, slide index, line markers, conversion on the render worker, html
+# wrapping, bytes copy), with stand-ins for Gedit.Window and Gedit.Document, for
+# each available backend. The jobs are built by pipeline/render.py, as in the
+# plugin, so code blocks and formulas are converted apart and cached.
+#
+# Usage: python3 benchmarks/bench_render.py [--sizes 1K,64K,1M,20M] [--repeat 5]
+#                                            [--output results.json] [--compare old.json]
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'markdown_preview')
+sys.path.insert(0, PLUGIN_DIR)
+
+from pipeline import render
+from pipeline.backends import BACKENDS
+from pipeline.cache import RenderCache, make_key
+from pipeline.document import detect_format, read_buffer
+from pipeline.server import PandocServer
+from pipeline.slides import SlideIndex
+from pipeline.worker import PandocJob, RenderWorker
+
+STAGES = ['read', 'index', 'markers', 'convert', 'wrap', 'encode', 'total']
+CACHE_MAX_BYTES = 32 * 1024 * 1024 # default of the cache-size setting
+
+################################################################################
+# Stand-ins for the Gedit objects used by the render path
+
+class FakeDocument:
+
+	def __init__(self, text, name):
+		self._text = text
+		self._name = name
+
+	def get_bounds(self):
+		return 0, len(self._text)
+
+	def get_text(self, start, end, include_hidden_chars):
+		# Gedit copies the buffer content into a new string
+		return ''.join(self._text[start:end])
+
+	def get_short_name_for_display(self):
+		return self._name
+
+	def get_location(self):
+		return None
+
+class FakeWindow:
+
+	def __init__(self, doc):
+		self._doc = doc
+
+	def get_active_document(self):
+		return self._doc
+
+################################################################################
+# Corpus
+
+def repeat_to_size(unit_function, size):
+	parts = []
+	length = 0
+	i = 0
+	while length < size:
+		part = unit_function(i)
+		parts.append(part)
+		length = length + len(part)
+		i = i + 1
+	return ''.join(parts)
+
+def gen_prose(i):
+	return '## Section %d\n\nSome *emphasized* text, a [link](http://example.com/%d) ' \
+		'and `inline code`, followed by a longer sentence to make a paragraph.\n\n' % (i, i)
+
+def gen_nested(i):
+	return ''.join('  ' * depth + '- item %d.%d\n' % (i, depth) for depth in range(8)) + '\n'
+
+def gen_table(i):
+	if i == 0:
+		return '| id | name | value | comment |\n|----|------|-------|---------|\n'
+	return '| %d | name %d | %d.5 | a comment about row %d |\n' % (i, i, i * 3, i)
+
+def gen_code(i):
+	return 'Block %d:\n\n```python\ndef function_%d(x):\n    return [y * %d for y in range(x)]\n```\n\n' % (i, i, i)
+
+def gen_slides(i):
+	return '# Slide %d\n\n- a point\n- another point\n\n---\n\n' % i
+
+CORPUS = {
+	'prose': gen_prose,
+	'nested': gen_nested,
+	'table': gen_table,
+	'code': gen_code,
+	'slides': gen_slides,
+}
+
+def parse_size(text):
+	units = {'K': 1024, 'M': 1024 * 1024}
+	if text[-1].upper() in units:
+		return int(float(text[:-1]) * units[text[-1].upper()])
+	return int(text)
+
+################################################################################
+# Measurement, in a fresh process for each case so peak RSS values are its own
+
+def percentile(values, fraction):
+	ordered = sorted(values)
+	index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+	return ordered[index]
+
+def call_now(function, *args):
+	# The worker delivers results on its own thread, instead of the main loop
+	function(*args)
+
+def convert(worker, job):
+	done = threading.Event()
+	worker.submit(job, lambda job: done.set())
+	done.wait()
+	if job.error is not None:
+		raise job.error
+	return job.result
+
+def run_case(kind, size, backend_name, repeat):
+	text = repeat_to_size(CORPUS[kind], size)
+	paginated = (kind == 'slides')
+	server = PandocServer() if backend_name == 'pandoc-server' else None
+	backend = 'pandoc' if backend_name == 'pandoc-server' else backend_name
+	args = ['--from', 'markdown']
+	render_cache = RenderCache(CACHE_MAX_BYTES)
+	fragment_cache = RenderCache(CACHE_MAX_BYTES)
+	worker = RenderWorker(call_now)
+	timings = dict((stage, []) for stage in STAGES)
+	spawned = PandocJob.spawned
+	try:
+		# The first iteration only warms up caches (and starts the server)
+		for i in range(repeat + 1):
+			# Each iteration follows an edit of the first slide, so the page
+			# isn't in the cache (unlike its code blocks and formulas).
+			window = FakeWindow(FakeDocument('Edit %d.\n\n' % i + text, 'bench.md'))
+			start = time.perf_counter()
+			doc = window.get_active_document()
+			doc_format = detect_format(doc.get_short_name_for_display())
+			source = read_buffer(doc)
+			t_read = time.perf_counter()
+			if paginated:
+				source = SlideIndex(source, 'markdown').get_slide(0)
+			t_index = time.perf_counter()
+			source = render.prepare_text('markdown', source, not paginated)
+			key = make_key('markdown', backend, source, paginated)
+			t_markers = time.perf_counter()
+			html_content = render_cache.get(key)
+			if html_content is None:
+				html_string = convert(worker, render.build_cached_job(render_cache, key, backend, \
+					'markdown', args, source, server, fragment_cache))
+			t_convert = time.perf_counter()
+			if html_content is None:
+				html_content = render.store_render(render_cache, key, html_string)
+			t_wrap = time.perf_counter()
+			size = len(html_content.encode('utf-8'))
+			end = time.perf_counter()
+			if i == 0:
+				continue
+			timings['read'].append(t_read - start)
+			timings['index'].append(t_index - t_read)
+			timings['markers'].append(t_markers - t_index)
+			timings['convert'].append(t_convert - t_markers)
+			timings['wrap'].append(t_wrap - t_convert)
+			timings['encode'].append(end - t_wrap)
+			timings['total'].append(end - start)
+		server_requests = server.requests if server is not None else 0
+		subprocesses = PandocJob.spawned - spawned
+		if server is not None:
+			subprocesses = subprocesses + server.restarts + 1
+	finally:
+		if server is not None:
+			server.stop()
+	stages = {}
+	for stage in STAGES:
+		stages[stage] = {
+			'p50_ms': percentile(timings[stage], 0.5) * 1000,
+			'p95_ms': percentile(timings[stage], 0.95) * 1000,
+		}
+	return {
+		'corpus': kind,
+		'size': len(text),
+		'format': doc_format,
+		'backend': backend_name,
+		'paginated': paginated,
+		'repeat': repeat,
+		'stages': stages,
+		'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		'peak_child_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+		'html_bytes': size,
+		'subprocesses': subprocesses,
+		'server_requests': server_requests,
+		'fragments': {'hits': fragment_cache.hits, 'misses': fragment_cache.misses},
+	}
+
+def get_available_backends():
+	backends = []
+	if shutil.which('pandoc') is not None:
+		backends.append('pandoc')
+		server = PandocServer()
+		try:
+			server.convert('probe', 'markdown')
+			backends.append('pandoc-server')
+		except Exception:
+			pass
+		finally:
+			server.stop()
+	if BACKENDS['commonmark'].is_available():
+		backends.append('commonmark')
+	return backends
+
+def get_revision():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PLUGIN_DIR, \
+			stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+	except OSError:
+		return None
+
+################################################################################
+
+def compare(results, baseline):
+	def key(r):
+		return (r['corpus'], r['size'], r['backend'])
+	old = dict((key(r), r) for r in baseline['results'])
+	print('%-8s %10s %-14s %10s %10s %7s' % ('corpus', 'size', 'backend', 'old p50', 'new p50', 'ratio'))
+	for r in results['results']:
+		if key(r) not in old:
+			continue
+		before = old[key(r)]['stages']['total']['p50_ms']
+		after = r['stages']['total']['p50_ms']
+		ratio = after / before if before > 0 else float('inf')
+		print('%-8s %10d %-14s %10.2f %10.2f %7.2f' % (r['corpus'], r['size'], r['backend'], \
+			before, after, ratio))
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the preview render pipeline.")
+	parser.add_argument('--sizes', default='1K,64K,1M', help="e.g. 1K,64K,1M,20M")
+	parser.add_argument('--corpus', default=','.join(CORPUS.keys()))
+	parser.add_argument('--backends', default=None, help="default: all available")
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--output', default=None, help="JSON file (default: stdout)")
+	parser.add_argument('--compare', default=None, help="JSON file of a previous run")
+	options = parser.parse_args()
+
+	if options.backends is None:
+		backends = get_available_backends()
+	else:
+		backends = options.backends.split(',')
+	results = {
+		'revision': get_revision(),
+		'python': sys.version.split()[0],
+		'results': [],
+	}
+	context = multiprocessing.get_context('spawn')
+	for kind in options.corpus.split(','):
+		for size in options.sizes.split(','):
+			for backend_name in backends:
+				with context.Pool(1) as pool:
+					result = pool.apply(run_case, (kind, parse_size(size), backend_name, options.repeat))
+				results['results'].append(result)
+				print('%-8s %10d %-14s p50 %9.2f ms  p95 %9.2f ms' % (kind, result['size'], \
+					backend_name, result['stages']['total']['p50_ms'], \
+					result['stages']['total']['p95_ms']), file=sys.stderr)
+
+	if options.output is None:
+		json.dump(results, sys.stdout, indent=1)
+		print()
+	else:
+		with open(options.output, 'w') as f:
+			json.dump(results, f, indent=1)
+	if options.compare is not None:
+		with open(options.compare) as f:
+			compare(results, json.load(f))
+
+if __name__ == '__main__':
+	main()
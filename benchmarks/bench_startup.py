@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# Activation cost of the plugin, measured on the real
+# MarkdownGeditPluginWindow.do_activate of each given revision. Gedit isn't
+# running: the plugin gets stand-ins for Gedit.Window and Gedit.Document built
+# from Gtk widgets, with a document which isn't supported by default (the most
+# common case). Each revision is extracted with `git archive` and measured in
+# fresh processes, with its own compiled settings schema.
+# It needs Gtk, WebKit2GTK, gedit's typelib and a display: use xvfb-run on a
+# headless machine.
+#
+# Usage: xvfb-run python3 benchmarks/bench_startup.py [--revisions REV1,REV2]
+#                                  [--document notes.txt] [--windows 10] [--repeat 5]
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCHEMA_NAME = 'org.gnome.gedit.plugins.markdown_preview.gschema.xml'
+# Where distributions install gedit's typelib and its private library
+GEDIT_LIBRARY_DIRS = ['/usr/lib/x86_64-linux-gnu/gedit', '/usr/lib64/gedit', '/usr/lib/gedit']
+
+################################################################################
+# Stand-ins for the Gedit objects used by do_activate, built in the child process
+
+def build_stubs(document_name):
+	from gi.repository import GObject, Gio, Gtk
+
+	class StubDocument(Gtk.TextBuffer):
+		__gsignals__ = {
+			'saved': (GObject.SignalFlags.RUN_LAST, None, ()),
+		}
+
+		def __init__(self, name):
+			Gtk.TextBuffer.__init__(self)
+			self._name = name
+			self.set_text('Some text.\n' * 100)
+
+		def get_short_name_for_display(self):
+			return self._name
+
+		def get_location(self):
+			return Gio.File.new_for_path(os.path.join(tempfile.gettempdir(), self._name))
+
+	class StubWindow(Gtk.ApplicationWindow):
+		# Gtk.ApplicationWindow is also an action map, like Gedit.Window
+		__gsignals__ = {
+			'active-tab-changed': (GObject.SignalFlags.RUN_LAST, None, (GObject.Object,)),
+			'tab-added': (GObject.SignalFlags.RUN_LAST, None, (GObject.Object,)),
+			'tab-removed': (GObject.SignalFlags.RUN_LAST, None, (GObject.Object,)),
+		}
+
+		def __init__(self, doc):
+			Gtk.ApplicationWindow.__init__(self)
+			self._doc = doc
+			self._view = Gtk.TextView.new_with_buffer(doc)
+			self._side_panel = Gtk.Stack()
+			self._bottom_panel = Gtk.Stack()
+			scrolled = Gtk.ScrolledWindow()
+			scrolled.add(self._view)
+			paned = Gtk.Paned(orientation=Gtk.Orientation.VERTICAL)
+			paned.pack1(scrolled, True, False)
+			paned.pack2(self._bottom_panel, False, False)
+			box = Gtk.Box()
+			box.pack_start(self._side_panel, False, False, 0)
+			box.pack_start(paned, True, True, 0)
+			self.add(box)
+			self.set_default_size(1200, 800)
+
+		def get_active_document(self):
+			return self._doc
+
+		def get_active_view(self):
+			return self._view
+
+		def get_documents(self):
+			return [self._doc]
+
+		def get_side_panel(self):
+			return self._side_panel
+
+		def get_bottom_panel(self):
+			return self._bottom_panel
+
+	return StubDocument, StubWindow
+
+################################################################################
+# Measurement, in the child process
+
+def run_revision(plugin_parent, document_name, windows):
+	import gi
+	gi.require_version('Gtk', '3.0')
+	from gi.repository import Gtk
+	StubDocument, StubWindow = build_stubs(document_name)
+	stubs = []
+	for i in range(windows):
+		window = StubWindow(StubDocument(document_name))
+		window.show_all()
+		stubs.append(window)
+	while Gtk.events_pending():
+		Gtk.main_iteration()
+	modules = len(sys.modules)
+
+	start = time.perf_counter()
+	sys.path.insert(0, plugin_parent)
+	import markdown_preview
+	t_import = time.perf_counter()
+
+	class BenchPluginWindow(markdown_preview.MarkdownGeditPluginWindow):
+		# The `window` property only accepts a Gedit.Window
+		__gtype_name__ = 'BenchPluginWindow'
+		window = None
+
+	plugins = []
+	for window in stubs:
+		plugin = BenchPluginWindow()
+		plugin.window = window
+		plugin.do_activate()
+		plugins.append(plugin)
+	t_activate = time.perf_counter()
+	# What was scheduled by do_activate (idle callbacks, first renders)
+	deadline = time.perf_counter() + 2
+	while Gtk.events_pending() and time.perf_counter() < deadline:
+		Gtk.main_iteration()
+	end = time.perf_counter()
+	print(json.dumps({
+		'windows': windows,
+		'document': document_name,
+		'import_ms': (t_import - start) * 1000,
+		'activation_ms': (t_activate - t_import) * 1000,
+		'settle_ms': (end - t_activate) * 1000,
+		'total_ms': (end - start) * 1000,
+		'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		'modules_loaded': len(sys.modules) - modules,
+	}))
+
+################################################################################
+
+def extract_revision(revision, directory):
+	# The plugin and its settings schema, as they were at this revision
+	archive = subprocess.run(['git', 'archive', revision, 'markdown_preview', SCHEMA_NAME], \
+		cwd=REPO_DIR, stdout=subprocess.PIPE, check=True).stdout
+	subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+	subprocess.run(['glib-compile-schemas', directory], check=True)
+
+def get_child_env(directory):
+	env = dict(os.environ)
+	env['GSETTINGS_SCHEMA_DIR'] = directory
+	for library_dir in GEDIT_LIBRARY_DIRS:
+		if os.path.isdir(os.path.join(library_dir, 'girepository-1.0')):
+			env['GI_TYPELIB_PATH'] = os.path.join(library_dir, 'girepository-1.0') + \
+				os.pathsep + env.get('GI_TYPELIB_PATH', '')
+			env['LD_LIBRARY_PATH'] = library_dir + os.pathsep + env.get('LD_LIBRARY_PATH', '')
+			break
+	# The disk caches of the user aren't touched
+	env['XDG_CACHE_HOME'] = os.path.join(directory, 'cache')
+	return env
+
+def get_commit(revision):
+	return subprocess.run(['git', 'rev-parse', '--short', revision], cwd=REPO_DIR, \
+		stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the plugin's activation.")
+	parser.add_argument('--revisions', default='HEAD', help="comma-separated, e.g. HEAD~3,HEAD")
+	parser.add_argument('--document', default='notes.txt', help="name of the active document")
+	parser.add_argument('--windows', type=int, default=10)
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--run-plugin', default=None, help=argparse.SUPPRESS)
+	options = parser.parse_args()
+
+	if options.run_plugin is not None:
+		run_revision(options.run_plugin, options.document, options.windows)
+		return
+	if os.environ.get('DISPLAY') is None and os.environ.get('WAYLAND_DISPLAY') is None:
+		parser.error('a display is needed: run it with xvfb-run')
+	results = []
+	for revision in options.revisions.split(','):
+		directory = tempfile.mkdtemp(prefix='bench-startup-')
+		try:
+			extract_revision(revision, directory)
+			runs = []
+			for i in range(options.repeat):
+				output = subprocess.run([sys.executable, os.path.abspath(__file__), \
+					'--run-plugin', directory, '--document', options.document, \
+					'--windows', str(options.windows)], env=get_child_env(directory), \
+					stdout=subprocess.PIPE, check=True).stdout
+				runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+		finally:
+			shutil.rmtree(directory, ignore_errors=True)
+		runs.sort(key=lambda r: r['total_ms'])
+		median = runs[len(runs) // 2]
+		median['revision'] = get_commit(revision)
+		results.append(median)
+		print('%-10s %3d windows: import %8.2f ms, do_activate %8.2f ms, settle %8.2f ms, ' \
+			'peak RSS %8d KiB' % (median['revision'], options.windows, median['import_ms'], \
+			median['activation_ms'], median['settle_ms'], median['peak_rss_kb']), file=sys.stderr)
+	json.dump(results, sys.stdout, indent=1)
+	print()
+
+if __name__ == '__main__':
+	main()
@@ -1,8 +1,28 @@
-import subprocess
 import gi
+import json
 import os
+import time
+import urllib.parse
+# WebKit2 itself is only loaded when the first preview is built
 gi.require_version('WebKit2', '4.0')
-from gi.repository import GObject, Gtk, Gedit, Gio, PeasGtk, WebKit2, GLib
+from gi.repository import GObject, Gtk, Gdk, Gedit, Gio, PeasGtk, GLib
+from .pipeline.worker import JobSequence, RenderLimitExceeded, RenderWorker
+from .pipeline.server import acquire_server, release_server
+from .pipeline.backends import BACKENDS, build_export_job, choose_export_backend
+from .pipeline.cache import RenderCache, make_key
+from .pipeline import blocks, render
+from .pipeline.images import ThumbnailCache, find_pictures, get_width_bucket
+from .pipeline.assets import build_reload_script, find_assets, get_inputs_stamp
+from .pipeline.export import ExportQueue, ExportRecord, ExportTask, PdfLatexJob
+from .pipeline.document import FORMATS, detect_format, read_buffer, wrap_html
+from .pipeline.slides import SlideIndex, split_html_pages
+from .pipeline.search import TextIndex
+from .pipeline.sourcemap import SCROLL_SCRIPT, get_block_lines
+from .pipeline.stats import RenderStats, RenderTrace, format_histogram, log_trace
+from .monitors import FileWatcher
+from .scheduler import RenderScheduler
+from .webviews import StyleSheetWatcher, WebViewPool, create_web_view, get_web_settings, prewarm, \
+	set_jit_option
 
 BASE_PATH = os.path.dirname(os.path.realpath(__file__))
 LOCALE_PATH = os.path.join(BASE_PATH, 'locale')
@@ -17,7 +37,23 @@ except:
 #################
 	
 MD_PREVIEW_KEY_BASE = 'org.gnome.gedit.plugins.markdown_preview'
-BASE_TEMP_NAME = '/tmp/gedit_plugin_markdown_preview'
+CACHE_DIR = os.path.join(GLib.get_user_cache_dir(), 'gedit-plugin-markdown-preview')
+DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+THUMBNAILS_MAX_BYTES = 128 * 1024 * 1024
+SEARCH_DELAY = 250 # ms
+# Matches WebKit looks for, to highlight them: past this number, it only selects
+# the current one (the count comes from the index of the page's text anyway)
+SEARCH_HIGHLIGHT_MAX = 100
+RESIZE_DELAY = 200 # ms, before the pictures are scaled again for a new width
+EDITOR_SYNC_DELAY = 0.2 # s, during which the editor doesn't scroll the preview back
+LARGE_WINDOW_BYTES = 64 * 1024 # of source rendered on each side of the cursor or viewport
+LARGE_VIEWPORT_LINES = 100 # of source displayed at once by the preview, roughly
+RETRY_DELAY = 5 # s before rendering again a text whose render was stopped, doubled each time
+RETRY_MAX_DELAY = 300 # s
+MAX_STOPPED_RENDERS = 32 # texts remembered for the retry delays
+
+# Before any preview exists, so every web process gets it
+set_jit_option(Gio.Settings.new(MD_PREVIEW_KEY_BASE))
 
 class MarkdownGeditPluginApp(GObject.Object, Gedit.AppActivatable):
 	__gtype_name__ = 'MarkdownGeditPluginApp'
@@ -36,10 +72,12 @@ class MarkdownGeditPluginApp(GObject.Object, Gedit.AppActivatable):
 		self.menu_ext = self.extend_menu('file-section-1')
 		menu = Gio.Menu()
 		menu_item_export = Gio.MenuItem.new(_("Export the preview"), 'win.export_doc')
+		menu_item_export_all = Gio.MenuItem.new(_("Export the open documents"), 'win.export_all')
 		menu_item_print = Gio.MenuItem.new(_("Print the preview"), 'win.print_doc')
 		menu_item_insert = Gio.MenuItem.new(_("Insert a picture"), 'win.insert_picture')
 #		menu_item_reload = Gio.MenuItem.new(_("Reload"), 'win.reload')
 		menu.append_item(menu_item_export)
+		menu.append_item(menu_item_export_all)
 		menu.append_item(menu_item_print)
 		menu.append_item(menu_item_insert)
 #		menu.append_item(menu_item_reload)
@@ -56,64 +94,167 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 
 	def __init__(self):
 		GObject.Object.__init__(self)
-		self.preview_bar = Gtk.Box()
+		self.preview_bar = None
 		
 		self._auto_reload = False
-		self._compteur_laid = 0
-	
-	# This is called every time the gui is updated
-	def do_update_state(self):
-		if self.window.get_active_view() is not None:
-			if self._auto_reload:
-				if self._compteur_laid > 3:
-					self._compteur_laid = 0
-					self.on_reload(None, None)
-				else:
-					self._compteur_laid = self._compteur_laid + 1
+		self._active_doc = None
+		self._doc_handler = None
+		self._saved_handler = None
 	
 	def do_activate(self):
-		# Defining the action which was set earlier in AppActivatable.
+		# Only what's needed to notice a supported document is done here. The
+		# preview itself (settings, web view, popovers) is built the first time
+		# a .md, .html or .tex document is active.
 		self._handlers = []
-		self._settings = Gio.Settings.new(MD_PREVIEW_KEY_BASE)
-		self._isAtBottom = (self._settings.get_string('position') == 'bottom')
-		self._handlers.append( self._settings.connect('changed::position', self.change_panel) )
+		self._settings_handlers = []
+		self._settings = None
 		self._is_paginated = False
-		self.insert_in_adequate_panel()
-		self._handlers.append( self.window.connect('active-tab-changed', self.on_reload) )
 		self._page_index = 0
-		self.temp_file_md = Gio.File.new_for_path(BASE_TEMP_NAME + '.md')
+		self._slide_index = None
+		self._slide_count = 1
+		self._stats = RenderStats()
+		self._trace = None
+		self._loading_trace = None
+		self._render_worker = RenderWorker(GLib.idle_add)
+		self._prefetch_worker = RenderWorker(GLib.idle_add)
+		self._scheduler = RenderScheduler(self.on_scheduled_reload)
+		self._export_queue = ExportQueue(GLib.idle_add, self.on_export_progress, \
+			record=ExportRecord(os.path.join(CACHE_DIR, 'exports.json')))
+		# Nothing is rendered while the preview can't be seen: it's only marked
+		# as dirty, and rendered once visible again.
+		self._dirty = False
+		self._auto_hidden = False
+		self._iconified = False
+		self._handlers.append( self.window.connect('active-tab-changed', self.on_active_tab_changed) )
+		self._handlers.append( self.window.connect('notify::is-active', self.on_visibility_changed) )
+		self._handlers.append( self.window.connect('window-state-event', self.on_window_state_changed) )
+		self._handlers.append( self.window.connect('tab-removed', self.on_tab_removed) )
+		self._handlers.append( self.window.connect('tab-added', self.on_tab_added) )
+		self._prewarm_source = None
+		self.connect_active_document()
+		# Defining the action which was set earlier in AppActivatable.
 		self._connect_menu()
 		self.window.lookup_action('export_doc').set_enabled(False)
+		self.window.lookup_action('export_all').set_enabled(False)
 		self.window.lookup_action('print_doc').set_enabled(False)
 		self.window.lookup_action('insert_picture').set_enabled(False)
+		if self.window.get_active_document() is not None and self.recognize_format() != 'error':
+			self.build_preview()
+	
+	def build_preview(self):
+		self._settings = Gio.Settings.new(MD_PREVIEW_KEY_BASE)
+		self._isAtBottom = (self._settings.get_string('position') == 'bottom')
+		self._server = None
+		self._render_cache = RenderCache(0)
+		self._block_cache = RenderCache(0)
+		self._fragment_cache = RenderCache(0)
+		self._thumbnails = ThumbnailCache(os.path.join(CACHE_DIR, 'thumbnails'), \
+			THUMBNAILS_MAX_BYTES, GLib.idle_add, self.on_thumbnail_created)
+		self._displayed_blocks = None
+		self._displayed_context = None
+		self._panel_handlers = []
+		self._search_timeout = None
+		self._search_hit = 0
+		self._editor_sync_until = 0
+		self._placeholder_ranges = []
+		self._preview_sync_source = None
+		# Texts whose render was stopped by the limits: key -> (retry time, delay)
+		self._stopped_renders = {}
+		self._retry_source = None
+		# The files of the active document: LaTeX inputs are part of the keys
+		self._file_watcher = FileWatcher(self.on_files_changed)
+		self._inputs = set()
+		self._inputs_stamp = ''
+		self._watched_source = None
+		settings_handlers = [
+			('position', self.change_panel),
+			('style', self.on_style_changed),
+			('pandoc-server', self.on_server_changed),
+			('cache-size', self.on_cache_changed),
+			('disk-cache', self.on_cache_changed),
+			('webview-pool-size', self.on_pool_changed),
+			('webview-pool-memory', self.on_pool_changed),
+			('webkit-jit', self.on_webkit_changed),
+			('webkit-plugins', self.on_webkit_changed),
+			('webkit-page-cache', self.on_webkit_changed),
+			('render-timeout', self.on_limits_changed),
+			('render-memory-limit', self.on_limits_changed),
+			('scroll-sync', self.on_line_markers_changed),
+		]
+		for key, handler in settings_handlers:
+			self._settings_handlers.append( self._settings.connect('changed::' + key, handler) )
+		self.on_server_changed(None, None)
+		self.on_cache_changed(None, None)
+		self.on_limits_changed(None, None)
+		self._style_watcher = StyleSheetWatcher(self.on_style_loaded)
+		self.preview_bar = Gtk.Box()
+		self.insert_in_adequate_panel()
+		self.on_style_changed(None, None)
+		self.window.lookup_action('export_all').set_enabled(True)
 				
 	def do_deactivate(self):
-		self._settings.disconnect(self._handlers[0])
-		self.window.disconnect(self._handlers[1])		
-		self.delete_temp_file()
+		for handler in self._handlers:
+			self.window.disconnect(handler)
+		self.disconnect_active_document()
+		self._scheduler.cancel()
+		self._render_worker.cancel()
+		self._prefetch_worker.cancel()
+		self._export_queue.shutdown()
+		if self._prewarm_source is not None:
+			GLib.source_remove(self._prewarm_source)
+		for name in ('export_doc', 'export_all', 'print_doc', 'insert_picture', 'reload_preview'):
+			self.window.remove_action(name)
+		if self.preview_bar is None:
+			return
+		for handler in self._settings_handlers:
+			self._settings.disconnect(handler)
+		if self._server is not None:
+			release_server()
+		if self._search_timeout is not None:
+			GLib.source_remove(self._search_timeout)
+		if self._preview_sync_source is not None:
+			GLib.source_remove(self._preview_sync_source)
+		if self._retry_source is not None:
+			GLib.source_remove(self._retry_source)
+		if self._resize_source is not None:
+			GLib.source_remove(self._resize_source)
+		self._style_watcher.stop()
+		self._file_watcher.stop()
 		self._remove_from_panel()
 
 	def _connect_menu(self):
 		action_export = Gio.SimpleAction(name='export_doc')
+		action_export_all = Gio.SimpleAction(name='export_all')
 		action_print = Gio.SimpleAction(name='print_doc')
 		action_insert = Gio.SimpleAction(name='insert_picture')
+		action_reload = Gio.SimpleAction(name='reload_preview')
 		action_export.connect('activate', self.export_doc)
+		action_export_all.connect('activate', self.export_all)
 		action_print.connect('activate', self.print_doc)
 		action_insert.connect('activate', self.insert_picture)
+		# Used by the context menu of the preview
+		action_reload.connect('activate', self.on_reload)
 		self.window.add_action(action_export)
+		self.window.add_action(action_export_all)
 		self.window.add_action(action_print)
 		self.window.add_action(action_insert)
-		
-#		action_reload = Gio.SimpleAction(name='reload')
-#		action_reload.connect('activate', self.on_reload)
-#		self.window.add_action(action_reload)
+		self.window.add_action(action_reload)
 		
 	def insert_in_adequate_panel(self):
-		# This is the preview itself
-		self._webview = WebKit2.WebView()
-		self._webview.connect('context-menu', self.on_context_menu)
+		# This is the preview itself: a stack of web views, one for each recent
+		# document if the pool is enabled.
+		self._view_stack = Gtk.Stack()
+		self._pool = WebViewPool(self._view_stack, self.create_webview)
+		self._resize_source = None
+		self._view_stack.connect('size-allocate', self.on_preview_resized)
+		self._view_entry = None
+		self._view_doc = None
+		self.on_pool_changed(None, None)
+		self.use_view_for(self.window.get_active_document())
 		
 		searchBtn = self.build_search_popover()
+		statsBtn = self.build_stats_popover()
+		exportBtn = self.build_export_popover()
 		menuBtn = self.build_menu_popover()
 		
 		# Building the interface
@@ -122,18 +263,18 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 		main_box = Gtk.Box(margin_left=5, margin_right=5, margin_top=5, margin_bottom=5, spacing=2)
 		main_box.props.homogeneous = False
 		self.pages_box.get_style_context().add_class('linked')
-
-		if self._isAtBottom:
-			self.preview_bar.props.orientation = Gtk.Orientation.HORIZONTAL
-			main_box.props.orientation = Gtk.Orientation.VERTICAL
-		else:
-			self.preview_bar.props.orientation = Gtk.Orientation.VERTICAL
-			main_box.props.orientation = Gtk.Orientation.HORIZONTAL
+		self._main_box = main_box
+		self.set_orientation()
 		
 		refreshBtn = self.build_button('toggled', 'view-refresh-symbolic')
 		refreshBtn.set_active(self._auto_reload)
 		refreshBtn.connect('toggled', self.on_set_reload)
 
+		# Shown while the preview is outdated because its render was stopped
+		self.stopped_icon = Gtk.Image.new_from_icon_name('dialog-warning-symbolic', \
+			Gtk.IconSize.BUTTON)
+		self.stopped_icon.set_no_show_all(True)
+		
 		previousBtn = self.build_button('clicked', 'go-previous-symbolic')
 		previousBtn.connect('clicked', self.on_previous_page)
 		self.pages_box.add(previousBtn)
@@ -144,16 +285,27 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 		
 		main_box.pack_end(menuBtn, expand=False, fill=False, padding=0)
 		main_box.pack_end(searchBtn, expand=False, fill=False, padding=0)
+		main_box.pack_end(statsBtn, expand=False, fill=False, padding=0)
+		main_box.pack_end(exportBtn, expand=False, fill=False, padding=0)
 		main_box.pack_start(refreshBtn, expand=False, fill=False, padding=0)
 		main_box.pack_start(self.pages_box, expand=False, fill=False, padding=0)
+		main_box.pack_start(self.stopped_icon, expand=False, fill=False, padding=0)
 
 		# main_box only contains the buttons, it will pack at the end (bottom or right) of
 		# the preview_bar object, where the webview has already been added.
 		self.preview_bar.pack_end(main_box, expand=False, fill=False, padding=0)
-		self.preview_bar.pack_start(self._webview, expand=True, fill=True, padding=0)
+		self.preview_bar.pack_start(self._view_stack, expand=True, fill=True, padding=0)
 		
 		self.show_on_panel()
 
+	def set_orientation(self):
+		if self._isAtBottom:
+			self.preview_bar.props.orientation = Gtk.Orientation.HORIZONTAL
+			self._main_box.props.orientation = Gtk.Orientation.VERTICAL
+		else:
+			self.preview_bar.props.orientation = Gtk.Orientation.VERTICAL
+			self._main_box.props.orientation = Gtk.Orientation.HORIZONTAL
+
 	def build_menu_popover(self):
 		
 		self.position_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
@@ -237,10 +389,9 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 			pass
 		else:
 			b.remove_all()
-		action_reload_preview = Gio.SimpleAction(name='reload_preview')
-		reloadItem = WebKit2.ContextMenuItem.new_from_gaction(action_reload_preview, _("Reload preview"), None)
-		self.window.add_action(action_reload_preview)
-		action_reload_preview.connect('activate', self.on_reload)
+		from gi.repository import WebKit2
+		reloadItem = WebKit2.ContextMenuItem.new_from_gaction( \
+			self.window.lookup_action('reload_preview'), _("Reload preview"), None)
 		b.append(reloadItem)
 		return False
 		
@@ -260,17 +411,18 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 		upBtn.connect('clicked', self.on_search_up)
 		downBtn = self.build_button('clicked', 'go-down-symbolic')
 		downBtn.connect('clicked', self.on_search_down)
+		jumpBtn = self.build_button('clicked', 'go-jump-symbolic')
+		jumpBtn.set_tooltip_text(_("Show in the document"))
+		jumpBtn.connect('clicked', self.on_search_jump)
 		
 		self._search_entry = Gtk.SearchEntry()
 		self._search_entry.connect('search-changed', self.on_search_changed)
 		search_box.add(self._search_entry)
 		search_box.add(upBtn)
 		search_box.add(downBtn)
+		search_box.add(jumpBtn)
 		search_box.get_style_context().add_class('linked')
 		
-		self.find_controller = self._webview.get_find_controller()
-		self.find_controller.connect('counted-matches', self.on_count_change)
-		
 		self.count_label = Gtk.Label(_("No result"))
 		
 		some_damn_box.add(search_box)
@@ -280,6 +432,124 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 		
 		return searchBtn
 		
+	def create_webview(self):
+		from gi.repository import WebKit2
+		webview = create_web_view(self._settings)
+		webview.connect('context-menu', self.on_context_menu)
+		webview.connect('load-changed', self.on_load_changed)
+		webview.connect('notify::zoom-level', self.on_zoom_changed)
+		# The page tells which source line is at its top when it's scrolled
+		manager = webview.get_user_content_manager()
+		manager.add_script(WebKit2.UserScript(SCROLL_SCRIPT, \
+			WebKit2.UserContentInjectedFrames.TOP_FRAME, \
+			WebKit2.UserScriptInjectionTime.END, None, None))
+		manager.register_script_message_handler('mdpScroll')
+		manager.connect('script-message-received::mdpScroll', self.on_preview_scrolled)
+		return webview
+	
+	def use_view_for(self, doc, styled=True):
+		entry = self._pool.acquire(doc)
+		self._view_doc = doc
+		self.apply_style(entry, styled)
+		if entry is self._view_entry:
+			return
+		zoom_level = 1
+		if self._view_entry is not None:
+			# What has been displayed block by block belongs to the previous view
+			self._view_entry.displayed_blocks = self._displayed_blocks
+			self._view_entry.displayed_context = self._displayed_context
+			zoom_level = self._webview.get_zoom_level()
+		self._view_entry = entry
+		self._webview = entry.view
+		self._webview.set_zoom_level(zoom_level)
+		self.find_controller = self._webview.get_find_controller()
+		self._displayed_blocks = entry.displayed_blocks
+		self._displayed_context = entry.displayed_context
+		self._view_stack.set_visible_child(self._webview)
+	
+	# The stylesheet is a user stylesheet of the web views, so it can be
+	# replaced in a displayed page without converting the document again.
+	def apply_style(self, entry, styled):
+		sheet = self._style_watcher.sheet if styled else None
+		entry.styled = styled
+		if entry.style_sheet is sheet:
+			return
+		manager = entry.view.get_user_content_manager()
+		manager.remove_all_style_sheets()
+		if sheet is not None:
+			manager.add_style_sheet(sheet)
+		entry.style_sheet = sheet
+	
+	def on_style_changed(self, a, b):
+		self._style_watcher.set_path(self._settings.get_string('style'))
+	
+	def on_style_loaded(self):
+		for entry in self._pool.get_entries():
+			self.apply_style(entry, entry.styled)
+	
+	def on_pool_changed(self, a, b):
+		self._pool.max_views = self._settings.get_int('webview-pool-size')
+		self._pool.max_bytes = self._settings.get_int('webview-pool-memory') * 1024 * 1024
+	
+	def on_tab_added(self, window, tab):
+		# The web process is started while a supported document is loaded,
+		# before the preview needs it.
+		name = tab.get_document().get_short_name_for_display()
+		if self.preview_bar is None and self._prewarm_source is None \
+		                          and detect_format(name) != 'error':
+			self._prewarm_source = GLib.idle_add(self.on_prewarm)
+	
+	def on_prewarm(self):
+		self._prewarm_source = None
+		prewarm()
+		return False
+	
+	def on_tab_removed(self, window, tab):
+		doc = tab.get_document()
+		self._stats.forget(doc)
+		if self.preview_bar is not None:
+			self._pool.remove(doc)
+	
+	def build_stats_popover(self):
+		statsBtn = self.build_button('toggled', 'utilities-system-monitor-symbolic')
+		statsBtn.connect('toggled', self.on_toggle_stats_mode)
+		
+		self._stats_popover = Gtk.Popover()
+		self._stats_popover.set_relative_to(statsBtn)
+		self.stats_label = Gtk.Label(_("No render yet"))
+		self.stats_label.get_style_context().add_class('monospace')
+		self.stats_label.props.margin = 6
+		self._stats_popover.add(self.stats_label)
+		self._stats_popover.connect('closed', self.on_popover_stats_closed, statsBtn)
+		
+		return statsBtn
+	
+	def build_export_popover(self):
+		# Only shown while exports are running, or when one of them has failed
+		exportBtn = self.build_button('toggled', 'document-send-symbolic')
+		exportBtn.connect('toggled', self.on_toggle_export_mode)
+		exportBtn.set_no_show_all(True)
+		self._export_btn = exportBtn
+		
+		self._export_popover = Gtk.Popover()
+		self._export_popover.set_relative_to(exportBtn)
+		export_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+		export_box.props.margin = 6
+		self._export_progress = Gtk.ProgressBar(show_text=True)
+		self.export_label = Gtk.Label()
+		self.export_label.set_xalign(0)
+		self.export_label.set_max_width_chars(60)
+		self.export_label.set_line_wrap(True)
+		self._export_cancel_btn = Gtk.Button(_("Cancel the exports"))
+		self._export_cancel_btn.connect('clicked', self.on_cancel_exports)
+		export_box.add(self._export_progress)
+		export_box.add(self.export_label)
+		export_box.add(self._export_cancel_btn)
+		self._export_popover.add(export_box)
+		self._export_popover.connect('closed', self.on_popover_export_closed, exportBtn)
+		
+		return exportBtn
+	
 	def build_button(self, mode, icon):
 		if mode is 'toggled':
 			btn = Gtk.ToggleButton()
@@ -296,7 +566,163 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 			self.on_reload(None, None)
 		else:
 			self._auto_reload = False
+			self._scheduler.cancel()
 
+	def connect_active_document(self):
+		# Auto-reload is driven by the edits of the active document only, and
+		# the preview follows the scrolling of its view.
+		self.disconnect_active_document()
+		self._active_doc = self.window.get_active_document()
+		if self._active_doc is not None:
+			self._doc_handler = self._active_doc.connect('changed', self.on_document_changed)
+			self._saved_handler = self._active_doc.connect('saved', self.on_document_saved)
+			self._active_adjustment = self.window.get_active_view().get_vadjustment()
+			self._adjustment_handler = self._active_adjustment.connect('value-changed', \
+				self.on_editor_scrolled)
+	
+	def disconnect_active_document(self):
+		if self._active_doc is not None:
+			self._active_doc.disconnect(self._doc_handler)
+			self._active_doc.disconnect(self._saved_handler)
+			self._active_adjustment.disconnect(self._adjustment_handler)
+		self._active_doc = None
+		self._doc_handler = None
+		self._saved_handler = None
+		self._active_adjustment = None
+		self._adjustment_handler = None
+	
+	def get_editor_line(self):
+		# The line at the top of the editor, counted from 1 like in the page
+		view = self.window.get_active_view()
+		if view is None:
+			return None
+		line_iter, line_top = view.get_line_at_y(view.get_visible_rect().y)
+		return line_iter.get_line() + 1
+	
+	def scroll_preview_to(self, line):
+		self._webview.run_javascript('window.mdpScrollToLine && mdpScrollToLine(%f);' \
+			% line, None, None, None)
+	
+	def on_editor_scrolled(self, adjustment):
+		# Scrolls caused by the preview itself are ignored, and the preview is
+		# only scrolled once per main loop iteration.
+		if self.preview_bar is None or not self._settings.get_boolean('scroll-sync'):
+			return
+		if time.monotonic() < self._editor_sync_until or self._preview_sync_source is not None:
+			return
+		if self.is_preview_visible():
+			self._preview_sync_source = GLib.idle_add(self.on_preview_sync)
+	
+	def on_preview_sync(self):
+		self._preview_sync_source = None
+		line = self.get_editor_line()
+		if line is not None:
+			self.scroll_preview_to(line)
+		return False
+	
+	def on_preview_scrolled(self, manager, js_result):
+		line = js_result.get_js_value().to_double()
+		for entry in self._pool.get_entries():
+			if entry.view.get_user_content_manager() is manager:
+				entry.anchor_line = line
+		if self._webview.get_user_content_manager() is not manager:
+			return
+		if self.shows_placeholders(line):
+			# More of a large document has to be rendered
+			self._scheduler.request()
+		if not self._settings.get_boolean('scroll-sync'):
+			return
+		doc = self.window.get_active_document()
+		line_iter = doc.get_iter_at_line(max(0, int(line) - 1))
+		self._editor_sync_until = time.monotonic() + EDITOR_SYNC_DELAY
+		self.window.get_active_view().scroll_to_iter(line_iter, 0, True, 0, 0)
+	
+	def on_active_tab_changed(self, window, tab):
+		self._scheduler.cancel()
+		self.connect_active_document()
+		self.on_reload(None, None)
+	
+	def on_document_changed(self, doc):
+		if not self._auto_reload:
+			return
+		self.request_refresh()
+	
+	def on_document_saved(self, doc, *args):
+		# Without auto-reload, the preview shows the saved file. With it, the
+		# text is already displayed, unless it's been saved somewhere else.
+		self.request_refresh()
+	
+	def request_refresh(self):
+		if self.is_preview_visible():
+			self._scheduler.request()
+		else:
+			self._dirty = True
+	
+	def watch_files(self, doc, text):
+		# The document's file and the local files it refers to are watched. The
+		# text is only searched again when it has changed.
+		location = doc.get_location()
+		path = None if location is None else location.get_path()
+		if (path, text) != self._watched_source:
+			self._watched_source = (path, text)
+			if path is None:
+				resources, self._inputs = set(), set()
+			else:
+				resources, self._inputs = find_assets(text, self.recognize_format(), \
+					os.path.dirname(path))
+				resources.add(path)
+			self._file_watcher.set_paths(resources | self._inputs)
+		self._inputs_stamp = get_inputs_stamp(self._inputs)
+	
+	def on_files_changed(self, paths):
+		# Pictures and stylesheets are reloaded in the page, without rendering
+		# it again. The document's file only matters if the preview shows the
+		# saved file rather than the buffer.
+		doc = self.window.get_active_document()
+		location = None if doc is None else doc.get_location()
+		if location is None or self.preview_bar is None:
+			return
+		resources = paths - self._inputs - {location.get_path()}
+		if len(resources) > 0:
+			self.reload_resources(resources)
+		# A document deleted or moved away keeps its current page
+		if not os.path.exists(location.get_path()):
+			return
+		if len(paths & self._inputs) > 0 or \
+		                (location.get_path() in paths and not self._auto_reload):
+			self.request_refresh()
+	
+	def reload_resources(self, paths):
+		sources = {}
+		for path in paths:
+			sources[path] = None
+			if self._settings.get_boolean('image-thumbnails'):
+				# A new scaled copy, or the original until it's ready
+				src = self._thumbnails.get_src(path, self.get_image_width())
+				sources[path] = None if src == 'file://' + urllib.parse.quote(path) else src
+		self._webview.run_javascript(build_reload_script(sources), None, None, None)
+	
+	def is_preview_visible(self):
+		if self.preview_bar is None:
+			return False
+		# A panel hidden by the plugin itself (because the document isn't
+		# supported) is shown again by on_reload, so it doesn't count.
+		panel_visible = self.panel.get_visible() or self._auto_hidden
+		return panel_visible and self.panel.get_visible_child() is self.preview_bar \
+			and self.window.is_active() and not self._iconified
+	
+	def on_visibility_changed(self, *args):
+		if self._dirty and self.is_preview_visible():
+			self.on_reload(None, None)
+	
+	def on_window_state_changed(self, window, event):
+		self._iconified = bool(event.new_window_state & Gdk.WindowState.ICONIFIED)
+		self.on_visibility_changed()
+		return False
+	
+	def on_scheduled_reload(self):
+		self.on_reload(None, None)
+	
 	def on_hide_panel(self, btn):
 		if self._isAtBottom:
 			self.window.get_bottom_panel().set_property('visible', False)
@@ -321,25 +747,21 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 #			btn.set_sensitive(False)
 			
 	def on_next_page(self, btn):
-		self._page_index = self._page_index +1
-		self.on_reload(None, None)
-	
-	def delete_temp_file(self):
-		if self.temp_file_md.query_exists():
-			self.temp_file_md.delete()
+		if self._page_index < self._slide_count - 1:
+			self._page_index = self._page_index +1
+			self.on_reload(None, None)
 	
 	def recognize_format(self):
 		doc = self.window.get_active_document()
 		
 		# It will not load documents which are not .md
-		name = doc.get_short_name_for_display()
-		temp = name.split('.')
-		if temp[len(temp)-1] == 'md':
+		doc_format = detect_format(doc.get_short_name_for_display())
+		if doc_format == 'md':
 			return 'md'
-		elif temp[len(temp)-1] == 'html':
+		elif doc_format == 'html':
 			self.window.lookup_action('insert_picture').set_enabled(False)
 			return 'html'
-		elif temp[len(temp)-1] == 'tex':
+		elif doc_format == 'tex':
 			self.window.lookup_action('insert_picture').set_enabled(False)
 			return 'tex'
 		else:
@@ -351,56 +773,532 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 	
 	# This needs dummy parameters because it's connected to a signal which give arguments.
 	def on_reload(self, osef, oseb):
+		# The preview is built for the first supported document
+		if self.preview_bar is None:
+			if self.window.get_active_document() is None or self.recognize_format() == 'error':
+				return
+			self.build_preview()
+		
+		# Guard clause: nobody would see the result
+		if not self.is_preview_visible():
+			self._dirty = True
+			self._scheduler.cancel()
+			return
+		self._dirty = False
+		self._auto_hidden = False
+		self._placeholder_ranges = []
+		self.stopped_icon.hide()
+		
 		# Guard clause: it will not load documents which are not .md
-		if self.recognize_format() is 'error':
+		if self.recognize_format() == 'error':
+			self._render_worker.cancel()
+			self._file_watcher.set_paths([])
+			self._watched_source = None
 			if len(self.panel.get_children()) is 1:
+				self._auto_hidden = True
 				self.panel.hide()
 			return
-		elif self.recognize_format() is 'html':
+		elif self.recognize_format() == 'html':
+			# No conversion is needed, but a render still running for another tab
+			# must not replace this content when it ends.
+			self._render_worker.cancel()
 			self.panel.show()
 			doc = self.window.get_active_document()
-			start, end = doc.get_bounds()
-			html_string = doc.get_text(start, end, True)
-			pre_string = '<html><head><meta charset="utf-8" /></head><body>'
-			post_string = '</body></html>'
-			html_string = self.current_page(html_string)
-			html_content = pre_string + html_string + post_string
+			self.use_view_for(doc, False)
+			self.start_trace(doc, 'html')
+			html_string = read_buffer(doc)
+			self._trace.mark('read')
+			self.watch_files(doc, html_string)
+			if self._is_paginated:
+				html_string = self.get_slide(html_string, 'html')
+			html_content = wrap_html(html_string)
+			self._trace.mark('wrap')
+			self.load_html(html_content)
 		
-		elif self.recognize_format() is 'tex':
+		elif self.recognize_format() == 'tex':
 			self.panel.show()
 			doc = self.window.get_active_document()
-			file_path = doc.get_location().get_path()
+			self.use_view_for(doc)
+			self.start_trace(doc, 'tex')
+			text = self.get_source_text(doc)
+			if text is None:
+				return
+			self._trace.mark('read')
+			self.watch_files(doc, text)
 			
-			# It uses pandoc to produce the html code
-			pre_string = '<html><head><meta charset="utf-8" /><link rel="stylesheet" href="' + \
-				self._settings.get_string('style') + '" /></head><body>'
-			post_string = '</body></html>'
-			result = subprocess.run(['pandoc', file_path], stdout=subprocess.PIPE)
-			html_string = result.stdout.decode('utf-8')
-			html_string = self.current_page(html_string)
-			html_content = pre_string + html_string + post_string
+			# It uses pandoc to produce the html code, on another thread. Only the
+			# sections which have changed are converted again.
+			args = ['--from', 'latex'] + self.get_resource_args(doc)
+			if self._is_paginated or blocks.needs_full_render(text, 'latex'):
+				self.render_with_cache('latex', args, text, self._is_paginated)
+			else:
+				self.render_blocks('latex', args, text)
 		else:
 			self.panel.show()
-			# Get the current document, or the temporary document if requested
 			doc = self.window.get_active_document()
-			if self._auto_reload:
-				start, end = doc.get_bounds()
-				unsaved_text = doc.get_text(start, end, True)
-				f = open(BASE_TEMP_NAME + '.md', 'w')
-				f.write(unsaved_text)
-				f.close()
-				file_path = self.temp_file_md.get_path()
-			else:
-				file_path = doc.get_location().get_path()
+			self.use_view_for(doc)
+			self.start_trace(doc, 'md')
+			text = self.get_source_text(doc)
+			if text is None:
+				return
+			self._trace.mark('read')
+			self.watch_files(doc, text)
 			
-			# It uses pandoc to produce the html code
-			pre_string = '<html><head><meta charset="utf-8" /><link rel="stylesheet" href="' + \
-				self._settings.get_string('style') + '" /></head><body>'
-			post_string = '</body></html>'
-			result = subprocess.run(['pandoc', file_path], stdout=subprocess.PIPE)
-			html_string = result.stdout.decode('utf-8')
+			# It uses pandoc to produce the html code, on another thread. The text
+			# is given through stdin, so no temporary file is written.
+			args = ['--from', 'markdown'] + self.get_resource_args(doc)
+			if self._is_paginated and blocks.needs_full_render(text):
+				# Metadata, reference links and footnotes may be defined in
+				# another slide: the page is cut from the whole document.
+				self.render_with_cache('markdown', args, text, True)
+			elif self._is_paginated:
+				# Only the visible slide is converted, and its neighbours are
+				# prepared in the background.
+				self.render_with_cache('markdown', args, self.get_slide(text, 'markdown'))
+				self.prefetch_slides(args)
+			elif blocks.needs_full_render(text):
+				# Reference links and footnotes need their definitions, which
+				# are usually at the end: the document is rendered as a whole
+				self.render_with_cache('markdown', args, text)
+			elif self.is_large_document(text):
+				# Only what's around the cursor and the viewport is rendered
+				self.render_blocks('markdown', args, text, self.get_window_centers())
+			elif self._settings.get_boolean('incremental'):
+				self.render_blocks('markdown', args, text)
+			else:
+				self.render_with_cache('markdown', args, text)
+	
+	def get_slide(self, text, from_format):
+		# The index is only computed again when the text has changed
+		if self._slide_index is None or self._slide_index.text != text \
+		                             or self._slide_index.format != from_format:
+			self._slide_index = SlideIndex(text, from_format)
+		self._slide_count = self._slide_index.get_count()
+		self._page_index = self._slide_index.clamp(self._page_index)
+		return self._slide_index.get_slide(self._page_index)
+	
+	def prefetch_slides(self, args):
+		jobs = []
+		keys = []
+		for index in (self._page_index + 1, self._page_index - 1):
+			if index < 0 or index >= self._slide_count:
+				continue
+			slide = self._slide_index.get_slide(index)
+			key = self.get_cache_key('markdown', slide, index)
+			if self._render_cache.get(key) is None:
+				jobs.append(self.build_render_job('markdown', args, slide))
+				keys.append(key)
+		if len(jobs) == 0:
+			return
+		job = JobSequence(jobs)
+		job.keys = keys
+		self._prefetch_worker.submit(job, self.on_prefetch_done)
+	
+	def on_prefetch_done(self, job):
+		if job.result is None:
+			return
+		for key, html_string in zip(job.keys, job.result):
+			if html_string is not None:
+				self._render_cache.put(key, wrap_html(html_string))
+	
+	# With `centers`, only the blocks around these lines are rendered, and
+	# placeholders stand for the others.
+	def render_blocks(self, from_format, args, text, centers=None):
+		# Only the blocks which aren't cached yet are converted, all at once. The
+		# sections of a LaTeX document also depend on the macros of its preamble.
+		if from_format == 'latex':
+			preamble, block_texts = blocks.split_latex(text)
+			lines = get_block_lines(text, block_texts)
+		else:
+			preamble = ''
+			located = blocks.locate_blocks(text)
+			block_texts = [block_text for block_text, offset, line in located]
+			lines = [line for block_text, offset, line in located]
+		if centers is None:
+			items = [(block_text, line, None) for block_text, line in zip(block_texts, lines)]
+		else:
+			items, self._placeholder_ranges = blocks.window_blocks(block_texts, lines, \
+				centers, LARGE_WINDOW_BYTES)
+		backend_name = self.get_backend_name(from_format)
+		keys = []
+		lines = []
+		missing = {}
+		for block_text, line, placeholder in items:
+			if placeholder is not None:
+				key = make_key('placeholder', placeholder)
+				self._block_cache.put(key, placeholder)
+			else:
+				key = make_key(from_format, backend_name, preamble, block_text, self._inputs_stamp)
+				if key not in missing and self._block_cache.get(key) is None:
+					missing[key] = block_text
+			keys.append(key)
+			lines.append(line)
+		if len(missing) == 0:
+			self._render_worker.cancel()
+			self._trace.mark('cache')
+			self.show_blocks(keys, lines, from_format, args, text)
+			return
+		request_key = make_key('blocks', *missing.keys())
+		if self.is_render_delayed(request_key):
+			return
+		if from_format == 'latex':
+			job = self.build_render_job(from_format, args, \
+				blocks.join_latex(preamble, list(missing.values())))
+			job = blocks.BlocksJob(job, len(missing), blocks.split_latex_output)
+		else:
+			job = self.build_render_job(from_format, args, blocks.join_blocks(list(missing.values())))
+			job = blocks.BlocksJob(job, len(missing))
+		job.key = request_key
+		job.from_format = from_format
+		job.keys = keys
+		job.lines = lines
+		job.missing_keys = list(missing.keys())
+		job.args = args
+		job.source = text
+		job.trace = self._trace
+		self._render_worker.submit(job, self.on_blocks_done)
+	
+	def on_blocks_done(self, job):
+		self._scheduler.add_duration(job.elapsed)
+		self.trace_job(job)
+		if isinstance(job.error, RenderLimitExceeded):
+			self.on_render_stopped(job.key, job.error)
+			return
+		if job.error is not None:
+			# The blocks couldn't be converted separately, or pandoc failed
+			self.render_with_cache(job.from_format, job.args, job.source)
+			return
+		if job.result is None:
+			return
+		self._stopped_renders.pop(job.key, None)
+		for key, html in zip(job.missing_keys, job.result):
+			self._block_cache.put(key, html)
+		self.show_blocks(job.keys, job.lines, job.from_format, job.args, job.source)
+	
+	def show_blocks(self, keys, lines, from_format, args, text):
+		context = (self.window.get_active_document(), self.get_dummy_uri())
+		displayed = set()
+		if self._displayed_blocks is not None and self._displayed_context == context:
+			displayed = self._displayed_blocks
+		contents = {}
+		for key in keys:
+			if key in displayed:
+				continue
+			contents[key] = self._block_cache.get(key)
+			if contents[key] is None:
+				# Evicted in the meantime: let's not try again.
+				self.render_with_cache(from_format, args, text)
+				return
+		if len(displayed) > 0:
+			# The page is patched in place: no reload, no flickering, no scrolling.
+			for key in contents:
+				contents[key] = self.prepare_images(contents[key])
+			self._trace.mark('images')
+			script = blocks.build_patch_script(keys, lines, contents, displayed)
+			self._trace.mark('wrap')
+			self._webview.run_javascript(script, None, self.on_patch_done, self._trace)
+			html_string = ''.join(self._block_cache.get(key) or '' for key in keys)
+			self._pool.set_content(self._view_doc, None, html_string)
+		else:
+			html_string = ''.join(blocks.wrap_block(key, contents[key], line) \
+				for key, line in zip(keys, lines))
+			html_content = wrap_html(html_string)
+			self._trace.mark('wrap')
+			self.load_html(html_content)
+			self._displayed_context = context
+		self._displayed_blocks = set(keys)
+	
+	def get_cache_key(self, from_format, text, page_index):
+		return make_key(from_format, self.get_backend_name(from_format), text, \
+			self.get_dummy_uri(), self._is_paginated, self._is_paginated and page_index, \
+			self._inputs_stamp)
+	
+	def render_with_cache(self, from_format, args, text, split_pages=False):
+		line_markers = self._settings.get_boolean('scroll-sync') and not self._is_paginated
+		text = render.prepare_text(from_format, text, line_markers)
+		key = self.get_cache_key(from_format, text, self._page_index)
+		if self._view_entry.key == key:
+			# This view already displays it, e.g. when switching back to a tab
+			self._render_worker.cancel()
+			return
+		html_content = self._render_cache.get(key)
+		if html_content is not None:
+			# Nothing to convert, so a render still running is useless
+			self._render_worker.cancel()
+			self._trace.mark('cache')
+			self.load_html(html_content, key)
+			return
+		if self.is_render_delayed(key):
+			return
+		job = render.build_cached_job(self._render_cache, key, self.get_backend_name(from_format), \
+			from_format, args, text, self._server, self._fragment_cache, split_pages)
+		job.trace = self._trace
+		self._render_worker.submit(job, self.on_render_done)
+	
+	def get_backend_name(self, from_format):
+		backends = self._settings.get_value('backends').unpack()
+		return backends.get(from_format, 'pandoc')
+	
+	def build_render_job(self, from_format, args, text):
+		return render.build_render_job(self.get_backend_name(from_format), from_format, args, \
+			text, self._server, self._fragment_cache)
+	
+	def on_cache_changed(self, a, b):
+		self._render_cache.set_max_bytes(self._settings.get_int('cache-size') * 1024 * 1024)
+		self._block_cache.set_max_bytes(self._settings.get_int('cache-size') * 1024 * 1024)
+		self._fragment_cache.set_max_bytes(self._settings.get_int('cache-size') * 1024 * 1024)
+		if self._settings.get_boolean('disk-cache'):
+			self._render_cache.disk_dir = CACHE_DIR
+			self._render_cache.disk_max_bytes = DISK_CACHE_MAX_BYTES
+		else:
+			self._render_cache.disk_dir = None
+	
+	def on_server_changed(self, a, b):
+		if self._settings.get_boolean('pandoc-server'):
+			if self._server is None:
+				self._server = acquire_server()
+		elif self._server is not None:
+			release_server()
+			self._server = None
+	
+	def get_source_text(self, doc):
+		# The unsaved text when the preview follows the edits, or else the saved
+		# file. None if it can't be read (e.g. deleted): the last page stays.
+		location = doc.get_location()
+		if self._auto_reload or location is None:
+			return read_buffer(doc)
+		try:
+			success, contents, etag = location.load_contents(None)
+		except GLib.Error:
+			return None
+		return contents.decode('utf-8', 'replace')
+	
+	def get_resource_args(self, doc):
+		# Relative paths to pictures and other assets are resolved from the
+		# document's folder, since pandoc doesn't know where the text comes from.
+		location = doc.get_location()
+		if location is None or location.get_parent() is None:
+			return []
+		return ['--resource-path', location.get_parent().get_path()]
+	
+	# Called on the main loop when pandoc is done, unless the result is already
+	# outdated because another render has been requested since.
+	def on_render_done(self, job):
+		self._scheduler.add_duration(job.elapsed)
+		self.trace_job(job)
+		if isinstance(job.error, RenderLimitExceeded):
+			self.on_render_stopped(job.key, job.error)
+			return
+		if job.error is not None or job.result is None:
+			return
+		self._stopped_renders.pop(job.key, None)
+		if job.from_cache:
+			self.load_html(job.result, job.key)
+			return
+		html_string = job.result
+		if job.split_pages:
 			html_string = self.current_page(html_string)
-			html_content = pre_string + html_string + post_string
+		html_content = render.store_render(self._render_cache, job.key, html_string)
+		self._trace.mark('wrap')
+		self.load_html(html_content, job.key)
+	
+	# A render stopped by the time or memory limits: the last good preview stays
+	# displayed with a warning icon, and this text isn't rendered again before a
+	# delay, which grows each time its render is stopped.
+	def on_render_stopped(self, key, error):
+		self._stats.timeouts = self._stats.timeouts + 1
+		delay = RETRY_DELAY
+		if key in self._stopped_renders:
+			delay = min(self._stopped_renders.pop(key)[1] * 2, RETRY_MAX_DELAY)
+		self._stopped_renders[key] = (time.monotonic() + delay, delay)
+		if len(self._stopped_renders) > MAX_STOPPED_RENDERS:
+			del self._stopped_renders[next(iter(self._stopped_renders))]
+		self.show_stopped_icon(error.reason)
+		if self._retry_source is not None:
+			GLib.source_remove(self._retry_source)
+		self._retry_source = GLib.timeout_add(delay * 1000, self.on_retry_render)
+		if self._stats_popover.get_visible():
+			self.update_stats_label()
+	
+	def is_render_delayed(self, key):
+		if key not in self._stopped_renders:
+			return False
+		retry_time, delay = self._stopped_renders[key]
+		if time.monotonic() >= retry_time:
+			return False
+		self._render_worker.cancel()
+		self.show_stopped_icon(None)
+		return True
+	
+	def show_stopped_icon(self, reason):
+		if reason == 'memory':
+			self.stopped_icon.set_tooltip_text(_("Render stopped: too much memory used"))
+		elif reason is not None:
+			self.stopped_icon.set_tooltip_text(_("Render timed out"))
+		self.stopped_icon.show()
+	
+	def on_retry_render(self):
+		self._retry_source = None
+		self.on_reload(None, None)
+		return False
+	
+	def on_limits_changed(self, a, b):
+		timeout = self._settings.get_int('render-timeout') or None
+		memory = self._settings.get_int('render-memory-limit') * 1024 * 1024 or None
+		self._render_worker.set_limits(timeout, memory)
+		self._prefetch_worker.set_limits(timeout, memory)
+	
+	########
+	
+	def start_trace(self, doc, doc_format):
+		self._trace = RenderTrace(doc.get_short_name_for_display(), doc_format, doc)
+	
+	def trace_job(self, job):
+		# The stages measured on the worker thread; the rest of the time since
+		# the request was spent waiting for the worker.
+		self._trace = job.trace
+		waited = time.monotonic() - self._trace.start - self._trace.get_total()
+		for stage, seconds in job.timings.items():
+			self._trace.add(stage, seconds)
+			waited = waited - seconds
+		self._trace.add('queue', max(0, waited))
+		self._trace.skip()
+	
+	def on_load_changed(self, webview, event):
+		from gi.repository import WebKit2
+		if event != WebKit2.LoadEvent.FINISHED:
+			return
+		if self._loading_trace is not None:
+			self.finish_trace(self._loading_trace)
+			self._loading_trace = None
+		# A new page starts at the top: it's scrolled to where the editor is, or
+		# to where the previous page was.
+		if webview is not self._webview:
+			return
+		line = self._view_entry.anchor_line
+		if self._settings.get_boolean('scroll-sync'):
+			line = self.get_editor_line()
+		if line is not None:
+			self.scroll_preview_to(line)
+	
+	def on_patch_done(self, webview, result, trace):
+		try:
+			webview.run_javascript_finish(result)
+		except GLib.Error:
+			pass
+		self.finish_trace(trace)
+		# Placeholders replaced above the viewport would move the content
+		if len(self._placeholder_ranges) > 0 and self._view_entry.anchor_line is not None:
+			self.scroll_preview_to(self._view_entry.anchor_line)
+	
+	def is_large_document(self, text):
+		threshold = self._settings.get_int('large-document-size') * 1024
+		return threshold > 0 and len(text) > threshold
+	
+	def get_window_centers(self):
+		# The cursor, and the middle of the preview's viewport
+		doc = self.window.get_active_document()
+		centers = [doc.get_iter_at_mark(doc.get_insert()).get_line() + 1]
+		if self._view_entry.anchor_line is not None:
+			centers.append(self._view_entry.anchor_line + LARGE_VIEWPORT_LINES // 2)
+		return centers
+	
+	def shows_placeholders(self, line):
+		# Whether placeholders are in the viewport whose top is at this line
+		bottom = line + LARGE_VIEWPORT_LINES
+		return any(start <= bottom and end >= line for start, end in self._placeholder_ranges)
+	
+	def finish_trace(self, trace):
+		trace.mark('webkit')
+		self._stats.record(trace.key, trace)
+		if self._settings.get_boolean('debug-stats'):
+			log_trace(trace, scheduler=self._scheduler.get_stats(), \
+				cache=self._render_cache.get_stats())
+		if self._stats_popover.get_visible():
+			self.update_stats_label()
+	
+	def update_stats_label(self):
+		histogram = self._stats.get_histogram(self.window.get_active_document())
+		if histogram is None:
+			self.stats_label.set_text(_("No render yet"))
+			return
+		scheduler = self._scheduler.get_stats()
+		cache = self._render_cache.get_stats()
+		fragments = self._fragment_cache.get_stats()
+		text = format_histogram(histogram) + '\n\n' + \
+			_("Renders: %s requested, %s coalesced, %s executed") % \
+			(scheduler['requested'], scheduler['coalesced'], scheduler['executed']) + '\n' + \
+			_("Cache: %s hits, %s misses, %s KiB") % \
+			(cache['hits'], cache['misses'], cache['size'] // 1024) + '\n' + \
+			_("Code and formulas: %s hits, %s misses, %s KiB") % \
+			(fragments['hits'], fragments['misses'], fragments['size'] // 1024) + '\n' + \
+			_("Stopped by the limits: %s") % self._stats.timeouts
+		self.stats_label.set_text(text)
+	
+	def prepare_images(self, html_string):
+		# Pictures are scaled down to the width of the preview (and its zoom)
+		if not self._settings.get_boolean('image-thumbnails'):
+			self._view_entry.image_width = None
+			return html_string
+		width = self.get_image_width()
+		self._view_entry.image_width = get_width_bucket(width)
+		return self._thumbnails.rewrite(html_string, self.get_base_dir(), width)
+	
+	def get_base_dir(self):
+		location = self.window.get_active_document().get_location()
+		if location is not None and location.get_parent() is not None:
+			return location.get_parent().get_path()
+		return None
+	
+	def get_image_width(self):
+		width = self._view_stack.get_allocated_width() * self._view_stack.get_scale_factor() \
+			* self._webview.get_zoom_level()
+		return int(width)
+	
+	# The pictures are scaled again when the preview gets wider or narrower
+	# (panel resized, zoom), without rendering the page again.
+	def on_preview_resized(self, widget, allocation):
+		if self._resize_source is None:
+			self._resize_source = GLib.timeout_add(RESIZE_DELAY, self.on_resize_timeout)
+	
+	def on_resize_timeout(self):
+		self._resize_source = None
+		self.update_image_width()
+		return False
+	
+	def on_zoom_changed(self, webview, pspec):
+		if webview is self._webview:
+			self.update_image_width()
+	
+	def update_image_width(self):
+		entry = self._view_entry
+		if entry is None or entry.html is None or entry.image_width is None:
+			return
+		width = self.get_image_width()
+		if get_width_bucket(width) == entry.image_width:
+			return
+		entry.image_width = get_width_bucket(width)
+		sources = {}
+		for path in find_pictures(entry.html, self.get_base_dir()):
+			sources[path] = self._thumbnails.get_src(path, width)
+		if len(sources) > 0:
+			self._webview.run_javascript(build_reload_script(sources), None, None, None)
+	
+	def on_thumbnail_created(self, original_uri, thumbnail_uri):
+		# The pictures already displayed are replaced by their scaled copy
+		script = 'document.querySelectorAll("img[data-mdp-original]").forEach(function (img) {' + \
+			' if (img.dataset.mdpOriginal === ' + json.dumps(original_uri) + ') {' + \
+			' img.src = ' + json.dumps(thumbnail_uri) + '; } });'
+		for entry in self._pool.get_entries():
+			entry.view.run_javascript(script, None, None, None)
+	
+	# The key identifies the content, so it isn't loaded again in the same view
+	def load_html(self, html_content, key=None):
+		# Whatever was displayed block by block is replaced
+		self._displayed_blocks = None
+		html_content = self.prepare_images(html_content)
+		if self._trace is not None:
+			self._trace.mark('images')
 		
 		# The html code is converted into bytes
 		my_string = GLib.String()
@@ -410,8 +1308,12 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 		# This uri will be used as a reference for links and images using relative paths
 		dummy_uri = self.get_dummy_uri()
 		
-		# The content is loaded
+		# The content is loaded, WebKit's time is measured until 'load-changed'
+		if self._trace is not None:
+			self._trace.mark('bytes')
+		self._loading_trace = self._trace
 		self._webview.load_bytes(bytes_content, 'text/html', 'UTF-8', dummy_uri)
+		self._pool.set_content(self._view_doc, key, html_content)
 		
 		self.window.lookup_action('export_doc').set_enabled(True)
 		self.window.lookup_action('print_doc').set_enabled(True)
@@ -422,9 +1324,9 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 		if not self._is_paginated:
 			return html_string
 		
-		html_pages = html_string.split('<hr />')
-		if self._page_index is len(html_pages):
-			self._page_index = self._page_index -1
+		html_pages = split_html_pages(html_string)
+		self._slide_count = len(html_pages)
+		self._page_index = max(0, min(self._page_index, self._slide_count - 1))
 		html_current_page = html_pages[self._page_index]
 		return html_current_page
 	
@@ -442,6 +1344,8 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 		else:
 			self.panel = self.window.get_side_panel()
 		self.panel.add_titled(self.preview_bar, 'markdown_preview', _("Markdown Preview"))
+		self._panel_handlers.append( self.panel.connect('notify::visible', self.on_visibility_changed) )
+		self._panel_handlers.append( self.panel.connect('notify::visible-child', self.on_visibility_changed) )
 		self.preview_bar.show_all()
 		self.panel.set_visible_child(self.preview_bar)
 		self.pages_box.props.visible = self._is_paginated
@@ -450,6 +1354,9 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 			self.on_reload(None, None)
 
 	def _remove_from_panel(self):
+		for handler in self._panel_handlers:
+			self.panel.disconnect(handler)
+		self._panel_handlers = []
 		self.panel.remove(self.preview_bar)
 	
 	def on_zoom_in(self, a):
@@ -464,14 +1371,47 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 		self._webview.set_zoom_level(1)
 	
 	def change_position_for(self, w, string):
-		self._settings.set_string('position', string)
+		if w.get_active():
+			self._settings.set_string('position', string)
 	
 	########
 	
+	# The search waits for a pause in the typing. Matches are counted with an
+	# index of the page's text, built at the first search after each render;
+	# WebKit only highlights them.
 	def on_search_changed(self, a):
+		if self._search_timeout is not None:
+			GLib.source_remove(self._search_timeout)
+		self._search_timeout = GLib.timeout_add(SEARCH_DELAY, self.on_search_timeout)
+	
+	def on_search_timeout(self):
+		from gi.repository import WebKit2
+		self._search_timeout = None
 		text = self._search_entry.get_text()
-		self.find_controller.count_matches(text, WebKit2.FindOptions.CASE_INSENSITIVE, 100)
-		self.find_controller.search(text, WebKit2.FindOptions.CASE_INSENSITIVE, 100)
+		matches = self.get_search_matches()
+		self._search_hit = 0
+		if len(matches) > 0:
+			self.find_controller.search(text, WebKit2.FindOptions.CASE_INSENSITIVE | \
+				WebKit2.FindOptions.WRAP_AROUND, SEARCH_HIGHLIGHT_MAX)
+		else:
+			self.find_controller.search_finish()
+		self.update_count_label()
+		return False
+	
+	def get_search_matches(self):
+		entry = self._view_entry
+		if entry.html is None:
+			return []
+		if entry.text_index is None:
+			entry.text_index = TextIndex(entry.html)
+		return entry.text_index.find(self._search_entry.get_text())
+	
+	def update_count_label(self):
+		count = len(self.get_search_matches())
+		if count == 0:
+			self.count_label.set_text(_("No result"))
+		else:
+			self.count_label.set_text(_("%s of %s results") % (self._search_hit + 1, count))
 	
 	def on_toggle_search_mode(self, a):
 		self._search_popover.show_all()
@@ -485,14 +1425,49 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 	def on_popover_menu_closed(self, popover, button):
 		button.set_active(False)
 	
+	def on_toggle_stats_mode(self, a):
+		self.update_stats_label()
+		self._stats_popover.show_all()
+	
+	def on_popover_stats_closed(self, popover, button):
+		button.set_active(False)
+	
+	def on_toggle_export_mode(self, a):
+		self._export_popover.show_all()
+	
+	def on_popover_export_closed(self, popover, button):
+		button.set_active(False)
+	
 	def on_search_up(self, btn):
+		count = len(self.get_search_matches())
+		if count == 0:
+			return
+		self._search_hit = (self._search_hit - 1) % count
 		self.find_controller.search_previous()
+		self.update_count_label()
 		
 	def on_search_down(self, btn):
+		count = len(self.get_search_matches())
+		if count == 0:
+			return
+		self._search_hit = (self._search_hit + 1) % count
 		self.find_controller.search_next()
+		self.update_count_label()
 	
-	def on_count_change(self, find_ctrl, number):
-		self.count_label.set_text(_("%s results") % number)
+	def on_search_jump(self, btn):
+		# The cursor is moved to the line of the source where the current match is
+		matches = self.get_search_matches()
+		if len(matches) == 0:
+			return
+		doc = self.window.get_active_document()
+		query = ' '.join(self._search_entry.get_text().split())
+		line = self._view_entry.text_index.find_source_line(read_buffer(doc), \
+			matches[min(self._search_hit, len(matches) - 1)], len(query))
+		if line is None:
+			return
+		doc.place_cursor(doc.get_iter_at_line(line))
+		self.window.get_active_view().scroll_to_cursor()
+		self.window.get_active_view().grab_focus()
 		
 	########
 	
@@ -521,21 +1496,37 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 		file_chooser.destroy()
 	
 	def change_panel(self, a, b):
+		isAtBottom = (self._settings.get_string('position') == 'bottom')
+		if isAtBottom == self._isAtBottom:
+			return
+		# The same widgets, with the same web views and pages, are moved
 		self._remove_from_panel()
-		self.preview_bar = Gtk.Box()
-		self._isAtBottom = (self._settings.get_string('position') == 'bottom')
-		self.insert_in_adequate_panel()
-		self.do_update_state()
+		self._isAtBottom = isAtBottom
+		self.set_orientation()
+		self.sideBtn.set_active(not self._isAtBottom)
+		self.bottomBtn.set_active(self._isAtBottom)
+		self.show_on_panel()
 		self.on_reload(None, None)
 	
+	def on_webkit_changed(self, a, b):
+		get_web_settings(self._settings)
+	
 	def do_create_configure_widget(self):
 		# Just return your box, PeasGtk will automatically pack it into a box and show it.
 		widget = MdConfigWidget(self.plugin_info.get_data_dir())
 		return widget.get_box()
 
+	# Exports are queued and run in the background: the file on disk is
+	# converted, so the document has to be saved.
 	def export_doc(self, a, b):
-		if (self.recognize_format() == 'tex') and self._settings.get_boolean('pdflatex'): #FIXME mauvais path?
-			subprocess.run(['pdflatex', self.window.get_active_document().get_location().get_path()])
+		location = self.window.get_active_document().get_location()
+		if location is None:
+			return
+		input_path = location.get_path()
+		if (self.recognize_format() == 'tex') and self._settings.get_boolean('pdflatex'):
+			job = PdfLatexJob(input_path, os.path.join(CACHE_DIR, 'latex', make_key(input_path)))
+			# The job knows itself whether the included files have changed
+			self._export_queue.submit(ExportTask(job, input_path, job.get_output_path()))
 		else:
 			file_chooser = Gtk.FileChooserDialog(_("Export the preview"), self.window,
 				Gtk.FileChooserAction.SAVE,
@@ -545,13 +1536,98 @@ class MarkdownGeditPluginWindow(GObject.Object, Gedit.WindowActivatable, PeasGtk
 			
 			# It gets the chosen file's path
 			if response == Gtk.ResponseType.OK:
-				if (file_chooser.get_filename().split('.')[-1] == 'html'):
-					subprocess.run(['pandoc', self.window.get_active_document().get_location().get_path(), '-o', file_chooser.get_filename()])
-				else: # in the future it shall behave differently
-					subprocess.run(['pandoc', self.window.get_active_document().get_location().get_path(), '-o', file_chooser.get_filename()])
+				from_format = FORMATS.get(self.recognize_format(), 'markdown')
+				output_path = file_chooser.get_filename()
+				self._export_queue.submit(self.build_export_task(from_format, \
+					input_path, output_path))
 			file_chooser.destroy()
+	
+	def build_export_task(self, from_format, input_path, output_path):
+		name = self.get_backend_name(from_format)
+		job = build_export_job(name, from_format, input_path, output_path)
+		# The choice between the backend and pandoc only depends on the source
+		return ExportTask(job, input_path, output_path, \
+			choose_export_backend(name, from_format, output_path).name)
+	
+	def export_all(self, a, b):
+		# Every saved markdown document can be exported, next to its source file
+		documents = [doc for doc in self.window.get_documents() \
+			if doc.get_location() is not None and \
+			detect_format(doc.get_short_name_for_display()) == 'md']
+		if len(documents) == 0:
+			return
+		dialog = Gtk.Dialog(_("Export the open documents"), self.window, \
+			Gtk.DialogFlags.MODAL | Gtk.DialogFlags.DESTROY_WITH_PARENT, \
+			(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, \
+			_("Export"), Gtk.ResponseType.OK))
+		content_box = dialog.get_content_area()
+		content_box.props.spacing = 6
+		content_box.props.margin = 10
+		checks = []
+		for doc in documents:
+			check = Gtk.CheckButton(doc.get_short_name_for_display())
+			check.set_tooltip_text(doc.get_location().get_path())
+			check.set_active(True)
+			content_box.add(check)
+			checks.append(check)
+		formatBox = Gtk.Box(spacing=20)
+		formatBox.pack_start(Gtk.Label(_("Format")), expand=False, fill=False, padding=0)
+		formatCombobox = Gtk.ComboBoxText()
+		formatCombobox.append('html', "HTML")
+		formatCombobox.append('pdf', "PDF")
+		formatCombobox.append('odt', "OpenDocument")
+		formatCombobox.append('docx', "Word")
+		formatCombobox.set_active_id('html')
+		formatBox.pack_end(formatCombobox, expand=False, fill=False, padding=0)
+		content_box.add(formatBox)
+		dialog.show_all()
+		response = dialog.run()
+		
+		if response == Gtk.ResponseType.OK:
+			extension = formatCombobox.get_active_id()
+			for doc, check in zip(documents, checks):
+				if not check.get_active():
+					continue
+				input_path = doc.get_location().get_path()
+				output_path = os.path.splitext(input_path)[0] + '.' + extension
+				# Only the outputs exported before from the same text are skipped
+				self._export_queue.submit(self.build_export_task('markdown', \
+					input_path, output_path), True)
+		dialog.destroy()
+	
+	def on_export_progress(self, task):
+		if self.preview_bar is None:
+			return
+		states = {
+			'queued': _("waiting"),
+			'running': _("exporting…"),
+			'done': _("exported"),
+			'skipped': _("already up to date"),
+			'failed': _("failed"),
+			'cancelled': _("cancelled"),
+		}
+		finished, total = self._export_queue.get_progress()
+		busy = self._export_queue.is_busy()
+		failed = [t for t in self._export_queue.tasks if t.state == 'failed']
+		self._export_btn.set_visible(busy or len(failed) > 0)
+		self._export_cancel_btn.set_sensitive(busy)
+		self._export_progress.set_fraction(finished / total if total > 0 else 0)
+		self._export_progress.set_text(_("%s of %s exported") % (finished, total))
+		lines = []
+		for t in self._export_queue.tasks:
+			line = os.path.basename(t.output_path) + ' — ' + states[t.state]
+			if t.error:
+				line = line + '\n' + t.error.splitlines()[-1]
+			lines.append(line)
+		self.export_label.set_text('\n'.join(lines))
+		if task is not None and task.state == 'failed':
+			self._export_btn.set_active(True)
+	
+	def on_cancel_exports(self, btn):
+		self._export_queue.cancel()
 		
 	def print_doc(self, a, b):
+		from gi.repository import WebKit2
 		p = WebKit2.PrintOperation.new(self._webview)
 		p.run_dialog()
 
@@ -594,6 +1670,37 @@ class MdConfigWidget:
 		pdflatexSwitch.connect('notify::active', self.on_pdflatex_changed)
 		pdflatexSettingBox.pack_end(pdflatexSwitch, expand=False, fill=False, padding=0)
 		#--------
+		serverSettingBox=Gtk.Box()
+		serverSettingBox.props.spacing = 20
+		serverSettingBox.props.orientation = Gtk.Orientation.HORIZONTAL
+		serverSettingBox.pack_start(Gtk.Label(_("Keep pandoc running in the background")), expand=False, fill=False, padding=0)
+		serverSwitch = Gtk.Switch()
+		serverSwitch.set_state(self._settings.get_boolean('pandoc-server'))
+		serverSwitch.connect('notify::active', self.on_server_changed)
+		serverSettingBox.pack_end(serverSwitch, expand=False, fill=False, padding=0)
+		#--------
+		scrollSettingBox=Gtk.Box()
+		scrollSettingBox.props.spacing = 20
+		scrollSettingBox.props.orientation = Gtk.Orientation.HORIZONTAL
+		scrollSettingBox.pack_start(Gtk.Label(_("Synchronize the scrolling")), expand=False, fill=False, padding=0)
+		scrollSwitch = Gtk.Switch()
+		scrollSwitch.set_state(self._settings.get_boolean('scroll-sync'))
+		scrollSwitch.connect('notify::active', self.on_scroll_sync_changed)
+		scrollSettingBox.pack_end(scrollSwitch, expand=False, fill=False, padding=0)
+		#--------
+		backendSettingBox=Gtk.Box()
+		backendSettingBox.props.spacing = 20
+		backendSettingBox.props.orientation = Gtk.Orientation.HORIZONTAL
+		backendSettingBox.pack_start(Gtk.Label(_("Markdown renderer")), expand=False, fill=False, padding=0)
+		backendCombobox = Gtk.ComboBoxText()
+		backendCombobox.append('pandoc', "pandoc")
+		if BACKENDS['commonmark'].is_available():
+			backendCombobox.append('commonmark', _("CommonMark (faster)"))
+		backends = self._settings.get_value('backends').unpack()
+		backendCombobox.set_active_id(backends.get('markdown', 'pandoc'))
+		backendCombobox.connect('changed', self.on_backend_changed)
+		backendSettingBox.pack_end(backendCombobox, expand=False, fill=False, padding=0)
+		#--------
 		styleSettingBox=Gtk.Box()
 		styleSettingBox.props.spacing = 20
 		styleSettingBox.props.orientation = Gtk.Orientation.HORIZONTAL
@@ -610,6 +1717,9 @@ class MdConfigWidget:
 		self.box.add(positionSettingBox)
 		self.box.add(relativePathsSettingBox)
 		self.box.add(pdflatexSettingBox)
+		self.box.add(serverSettingBox)
+		self.box.add(scrollSettingBox)
+		self.box.add(backendSettingBox)
 		self.box.add(styleSettingBox)
 	
 	def get_box(self):
@@ -618,6 +1728,11 @@ class MdConfigWidget:
 	def on_position_changed(self, w):
 		self._settings.set_string('position', w.get_active_id())
 		
+	def on_backend_changed(self, w):
+		backends = self._settings.get_value('backends').unpack()
+		backends['markdown'] = w.get_active_id()
+		self._settings.set_value('backends', GLib.Variant('a{ss}', backends))
+		
 	def on_choose_css(self, w):
 		# Building a FileChooserDialog for CSS
 		file_chooser = Gtk.FileChooserDialog(_("Select a CSS file"), None, # FIXME
@@ -648,3 +1763,18 @@ class MdConfigWidget:
 		else:
 			self._settings.set_boolean('pdflatex', False)
 	
+	def on_server_changed(self, w, a):
+		if w.get_state():
+			self._settings.set_boolean('pandoc-server', True)
+		else:
+			self._settings.set_boolean('pandoc-server', False)
+	
+	def on_line_markers_changed(self, a, b):
+		# The markdown previews are rendered with or without the line markers
+		self.request_refresh()
+	
+	def on_scroll_sync_changed(self, w, a):
+		if w.get_state():
+			self._settings.set_boolean('scroll-sync', True)
+		else:
+			self._settings.set_boolean('scroll-sync', False)
@@ -0,0 +1,59 @@
+from gi.repository import Gio, GLib
+
+class FileWatcher:
+	# Gio monitors on a set of files (the document, and the local files it
+	# refers to). Changes are gathered for a moment, since editors write files
+	# in several steps, then `callback(paths)` is called on the main loop.
+
+	DELAY = 100 # ms
+
+	CHANGE_EVENTS = (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED, \
+		Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.RENAMED, \
+		Gio.FileMonitorEvent.MOVED_IN, Gio.FileMonitorEvent.MOVED_OUT)
+
+	def __init__(self, callback):
+		self._callback = callback
+		self._monitors = {}
+		self._changed = set()
+		self._timeout = None
+
+	def set_paths(self, paths):
+		# Only the monitors of new paths are created
+		paths = set(paths)
+		for path in set(self._monitors) - paths:
+			self._remove(path)
+		for path in paths - set(self._monitors):
+			monitor = Gio.File.new_for_path(path).monitor_file( \
+				Gio.FileMonitorFlags.WATCH_MOVES, None)
+			handler = monitor.connect('changed', self._on_file_changed, path)
+			self._monitors[path] = (monitor, handler)
+
+	def get_paths(self):
+		return set(self._monitors)
+
+	def stop(self):
+		for path in list(self._monitors):
+			self._remove(path)
+		if self._timeout is not None:
+			GLib.source_remove(self._timeout)
+			self._timeout = None
+		self._changed = set()
+
+	def _remove(self, path):
+		monitor, handler = self._monitors.pop(path)
+		monitor.disconnect(handler)
+		monitor.cancel()
+
+	def _on_file_changed(self, monitor, file, other_file, event, path):
+		if event not in self.CHANGE_EVENTS:
+			return
+		self._changed.add(path)
+		if self._timeout is None:
+			self._timeout = GLib.timeout_add(self.DELAY, self._on_timeout)
+
+	def _on_timeout(self):
+		self._timeout = None
+		changed = self._changed
+		self._changed = set()
+		self._callback(changed)
+		return False
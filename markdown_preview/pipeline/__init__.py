@@ -0,0 +1,2 @@
+# The render pipeline. Nothing in this package depends on Gtk or Gedit, only the
+# plugin itself (markdown_preview/__init__.py) does.
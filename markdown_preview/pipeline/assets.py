@@ -0,0 +1,102 @@
+import json
+import os
+import re
+import urllib.parse
+
+from .cache import make_key
+from .images import IMG_RE, SRC_RE, resolve_src
+
+# The local files a document refers to, which are watched along with it. Some
+# are only loaded by the page (pictures, stylesheets), so the preview reloads
+# them in place when they change; others are read by pandoc (LaTeX inputs), so
+# the document has to be rendered again.
+
+MD_IMAGE_RE = re.compile(r'!\[(?:[^\]\\]|\\.)*\]\(\s*<?([^)\s>]+)')
+LINK_RE = re.compile(r'<link\b[^>]*>', re.IGNORECASE)
+HREF_RE = re.compile(r'\shref=(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+GRAPHICS_RE = re.compile(r'\\includegraphics\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}')
+INPUT_RE = re.compile(r'\\(?:input|include)\s*\{([^}]+)\}')
+# Extensions tried when \includegraphics doesn't give one
+GRAPHICS_EXTENSIONS = ['', '.pdf', '.png', '.jpg', '.jpeg', '.eps']
+MAX_ASSETS = 256 # files watched for a document
+
+def _find_existing(base_dir, name, extensions):
+	for extension in extensions:
+		path = resolve_src(name.strip() + extension, base_dir)
+		if path is not None and os.path.isfile(path):
+			return path
+	return None
+
+def _find_tags(text, tag_re, attribute_re):
+	for tag in tag_re.findall(text):
+		match = attribute_re.search(tag)
+		if match is not None:
+			yield match.group(1) if match.group(1) is not None else match.group(2)
+
+def find_assets(text, file_format, base_dir):
+	# Returns (resources, inputs): the paths of the existing files loaded by the
+	# page, and of those read by pandoc.
+	resources = set()
+	inputs = set()
+	if base_dir is None or file_format == 'error':
+		return resources, inputs
+	if file_format == 'tex':
+		for name in GRAPHICS_RE.findall(text):
+			resources.add(_find_existing(base_dir, name, GRAPHICS_EXTENSIONS))
+		for name in INPUT_RE.findall(text):
+			inputs.add(_find_existing(base_dir, name, ['', '.tex']))
+	else:
+		sources = list(_find_tags(text, IMG_RE, SRC_RE)) + list(_find_tags(text, LINK_RE, HREF_RE))
+		if file_format == 'md':
+			sources = sources + MD_IMAGE_RE.findall(text)
+		for src in sources:
+			resources.add(_find_existing(base_dir, src.split('#')[0].split('?')[0], ['']))
+	resources.discard(None)
+	inputs.discard(None)
+	return set(sorted(resources)[:MAX_ASSETS]), set(sorted(inputs)[:MAX_ASSETS])
+
+def get_inputs_stamp(paths):
+	# Changes when one of the files does, so renders depending on them aren't
+	# taken from the cache.
+	stamps = []
+	for path in sorted(paths):
+		try:
+			stat = os.stat(path)
+			stamps.append((path, stat.st_mtime, stat.st_size))
+		except OSError:
+			stamps.append((path, None))
+	return make_key(*stamps) if len(stamps) > 0 else ''
+
+RELOAD_FUNCTION = '''(function (items) {
+	var version = Date.now();
+	function strip(url) {
+		return url.split('#')[0].split('?')[0];
+	}
+	items.forEach(function (item) {
+		document.querySelectorAll('img').forEach(function (img) {
+			if ((img.dataset.mdpOriginal || strip(img.src)) === item.uri) {
+				if (!item.src) {
+					img.src = item.uri + '?mdp=' + version;
+				} else if (img.src !== item.src) {
+					img.src = item.src;
+				}
+			}
+		});
+		document.querySelectorAll('link[rel~="stylesheet"]').forEach(function (link) {
+			if (strip(link.href) === item.uri) {
+				link.href = item.uri + '?mdp=' + version;
+			}
+		});
+	});
+	if (window.mdpInvalidate) {
+		window.mdpInvalidate();
+	}
+})'''
+
+def build_reload_script(sources):
+	# `sources` is {path: uri to display, or None if the file has changed}. A
+	# changed file is given a query, so WebKit loads it again instead of using
+	# its memory cache.
+	items = [{'uri': 'file://' + urllib.parse.quote(path), 'src': src} \
+		for path, src in sorted(sources.items())]
+	return RELOAD_FUNCTION + '(' + json.dumps(items) + ');'
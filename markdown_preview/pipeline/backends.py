@@ -0,0 +1,158 @@
+import re
+import threading
+import time
+
+from .worker import PandocJob
+from .server import ServerJob
+
+# The backends convert a document to html. Pandoc handles everything; other
+# backends are faster for what they support, and pandoc is used for the rest.
+
+class PandocBackend:
+	name = 'pandoc'
+
+	def is_available(self):
+		return True
+
+	def supports(self, from_format, text):
+		return True
+
+	def supports_export(self, from_format, output_path):
+		return True
+
+	def build_job(self, from_format, args, text, server=None):
+		if server is not None:
+			return ServerJob(server, from_format, args, text)
+		return PandocJob(args, text)
+
+	def build_export_job(self, from_format, input_path, output_path):
+		return PandocJob([input_path, '-o', output_path])
+
+class InProcessJob:
+	# A conversion done by a Python function, without any subprocess. It can't
+	# be interrupted, but its result is ignored once cancelled.
+
+	def __init__(self, function, *args):
+		self.function = function
+		self.args = args
+		self.result = None
+		self.error = None
+		self.elapsed = 0
+		self.timings = {}
+		self._cancelled = False
+
+	def run(self):
+		if self._cancelled:
+			return None
+		start = time.monotonic()
+		result = self.function(*self.args)
+		self.timings['convert'] = time.monotonic() - start
+		return None if self._cancelled else result
+
+	def cancel(self):
+		self._cancelled = True
+
+class CommonMarkBackend:
+	# CommonMark with GFM tables and strikethrough, rendered in-process by
+	# markdown-it-py (an optional dependency).
+	name = 'commonmark'
+
+	# Pandoc extensions this backend doesn't know about: citations, math, raw
+	# LaTeX, footnotes, fenced divs, attributes, definition lists, metadata.
+	PANDOC_ONLY_RE = re.compile(r'\[@|\$[^$\s]|\\\(|\\\[|\\begin\{|\[\^|^:::|' \
+		r'\{[#.][^}]*\}|^: |\A---\s*$|\A%', re.MULTILINE)
+
+	def __init__(self):
+		self._parser = None
+		self._lock = threading.Lock()
+		try:
+			import markdown_it
+			self._module = markdown_it
+		except ImportError:
+			self._module = None
+
+	def is_available(self):
+		return self._module is not None
+
+	def supports(self, from_format, text):
+		return from_format == 'markdown' and self.PANDOC_ONLY_RE.search(text) is None
+
+	def supports_export(self, from_format, output_path):
+		return from_format == 'markdown' and output_path.endswith('.html')
+
+	def build_job(self, from_format, args, text, server=None):
+		return InProcessJob(self.render, text)
+
+	def build_export_job(self, from_format, input_path, output_path):
+		return InProcessJob(self._export, input_path, output_path)
+
+	def render(self, text):
+		with self._lock:
+			if self._parser is None:
+				self._parser = self._module.MarkdownIt('commonmark') \
+					.enable('table').enable('strikethrough')
+			return self._parser.render(text)
+
+	def _export(self, input_path, output_path):
+		with open(input_path, 'r', encoding='utf-8') as f:
+			html = self.render(f.read())
+		with open(output_path, 'w', encoding='utf-8') as f:
+			f.write(html)
+		return html
+
+BACKENDS = {
+	'pandoc': PandocBackend(),
+	'commonmark': CommonMarkBackend(),
+}
+
+def choose_backend(name, from_format, text):
+	backend = BACKENDS.get(name)
+	if backend is None or not backend.is_available() or not backend.supports(from_format, text):
+		return BACKENDS['pandoc']
+	return backend
+
+def choose_export_backend(name, from_format, output_path):
+	backend = BACKENDS.get(name)
+	if backend is None or not backend.is_available() or \
+	                     not backend.supports_export(from_format, output_path):
+		return BACKENDS['pandoc']
+	return backend
+
+def build_export_job(name, from_format, input_path, output_path):
+	backend = choose_export_backend(name, from_format, output_path)
+	if backend.name == 'pandoc':
+		return backend.build_export_job(from_format, input_path, output_path)
+	return ExportChoiceJob(backend, from_format, input_path, output_path)
+
+class ExportChoiceJob:
+	# Exports with a backend other than pandoc, if it supports the text of the
+	# source (read on the export thread), or else with pandoc.
+
+	def __init__(self, backend, from_format, input_path, output_path):
+		self.backend = backend
+		self.from_format = from_format
+		self.input_path = input_path
+		self.output_path = output_path
+		self.result = None
+		self.error = None
+		self.elapsed = 0
+		self.timings = {}
+		self._current = None
+		self._cancelled = False
+
+	def run(self):
+		with open(self.input_path, 'r', encoding='utf-8') as f:
+			text = f.read()
+		backend = choose_backend(self.backend.name, self.from_format, text)
+		self._current = backend.build_export_job(self.from_format, self.input_path, \
+			self.output_path)
+		if self._cancelled:
+			return None
+		result = self._current.run()
+		self.timings = self._current.timings
+		return result
+
+	def cancel(self):
+		self._cancelled = True
+		if self._current is not None:
+			self._current.cancel()
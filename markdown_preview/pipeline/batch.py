@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import RenderCache, make_key
+from .document import FORMATS, detect_format, wrap_html
+from .render import build_render_job
+
+# Rendering whole trees of documents without gedit, e.g. to publish them: each
+# source is converted the way the preview converts it, and written as html in
+# an output folder with the same layout. A manifest in the output folder keeps
+# what each output was built from, so unchanged sources are skipped.
+
+MANIFEST_NAME = '.markdown-preview-manifest.json'
+FRAGMENTS_MAX_BYTES = 16 * 1024 * 1024
+
+def find_sources(source_dir, excluded_dir=None):
+	# Relative paths of the supported documents, in a stable order
+	sources = []
+	for directory, subdirectories, files in os.walk(source_dir):
+		subdirectories[:] = sorted(d for d in subdirectories if not d.startswith('.') \
+			and os.path.join(directory, d) != excluded_dir)
+		for name in sorted(files):
+			if detect_format(name) != 'error':
+				sources.append(os.path.relpath(os.path.join(directory, name), source_dir))
+	return sources
+
+def get_output_name(relative_path):
+	return os.path.splitext(relative_path)[0] + '.html'
+
+def find_collisions(sources):
+	# {relative path: error} for the sources which would be written to the same
+	# output (e.g. a.md and a.tex): none of them is rendered.
+	outputs = {}
+	for relative_path in sources:
+		outputs.setdefault(get_output_name(relative_path), []).append(relative_path)
+	errors = {}
+	for output_name, paths in outputs.items():
+		if len(paths) > 1:
+			for relative_path in paths:
+				errors[relative_path] = 'same output as ' + \
+					', '.join(path for path in paths if path != relative_path)
+	return errors
+
+def get_file_hash(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+def get_style_href(style, output_path):
+	# Local stylesheets are linked with a relative path, so the output folder
+	# can be moved or published as it is.
+	if style is None or re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', style):
+		return style
+	return os.path.relpath(os.path.abspath(style), os.path.dirname(os.path.abspath(output_path)))
+
+class Manifest:
+	# {relative path: {mtime, size, sha256}} for the sources of the outputs, and
+	# the key of the options they were rendered with: if the options change,
+	# every source is rendered again. Sources whose modification time or size
+	# differ are hashed, so a file which was only touched is still skipped.
+
+	def __init__(self, path, options_key):
+		self.path = path
+		self.options_key = options_key
+		self.entries = {}
+		self._lock = threading.Lock()
+		try:
+			with open(path, 'r', encoding='utf-8') as f:
+				data = json.load(f)
+			if data.get('options') == options_key:
+				self.entries = data.get('files', {})
+		except (OSError, ValueError):
+			pass
+
+	def is_up_to_date(self, relative_path, source_path, output_path):
+		entry = self.entries.get(relative_path)
+		if entry is None or not os.path.exists(output_path):
+			return False
+		stat = os.stat(source_path)
+		if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+			return True
+		if entry['size'] != stat.st_size or entry['sha256'] != get_file_hash(source_path):
+			return False
+		self.update(relative_path, source_path, entry['sha256'])
+		return True
+
+	def update(self, relative_path, source_path, digest=None):
+		stat = os.stat(source_path)
+		if digest is None:
+			digest = get_file_hash(source_path)
+		with self._lock:
+			self.entries[relative_path] = {'mtime': stat.st_mtime, 'size': stat.st_size, \
+				'sha256': digest}
+
+	def remove(self, relative_path):
+		with self._lock:
+			self.entries.pop(relative_path, None)
+
+	def save(self):
+		temporary = self.path + '.tmp'
+		with open(temporary, 'w', encoding='utf-8') as f:
+			json.dump({'options': self.options_key, 'files': self.entries}, f, \
+				indent=1, sort_keys=True)
+		os.replace(temporary, self.path)
+
+class BatchRenderer:
+	# Sources are converted in parallel: pandoc runs as separate processes, so
+	# one thread for each core is enough to keep them all busy.
+
+	def __init__(self, source_dir, output_dir, backend='pandoc', style=None, \
+	                                            max_workers=None, force=False):
+		self.source_dir = os.path.abspath(source_dir)
+		self.output_dir = os.path.abspath(output_dir)
+		self.backend = backend
+		self.style = style
+		self.max_workers = max_workers or os.cpu_count() or 1
+		self.force = force
+		self.errors = {}
+		# Code blocks and formulas are often repeated across a documentation
+		self._fragment_cache = RenderCache(FRAGMENTS_MAX_BYTES)
+		options_key = make_key(backend, style)
+		self.manifest = Manifest(os.path.join(self.output_dir, MANIFEST_NAME), options_key)
+
+	def render_file(self, relative_path):
+		# Returns the size of the source, or None if it was skipped
+		source_path = os.path.join(self.source_dir, relative_path)
+		output_path = os.path.join(self.output_dir, get_output_name(relative_path))
+		if not self.force and self.manifest.is_up_to_date(relative_path, source_path, output_path):
+			return None
+		with open(source_path, 'rb') as f:
+			data = f.read()
+		text = data.decode('utf-8')
+		file_format = detect_format(relative_path)
+		if file_format == 'html':
+			html_string = text
+		else:
+			from_format = FORMATS[file_format]
+			args = ['--from', from_format, '--resource-path', os.path.dirname(source_path)]
+			html_string = build_render_job(self.backend, from_format, args, text, None, \
+				self._fragment_cache).run()
+		html_content = wrap_html(html_string, get_style_href(self.style, output_path))
+		os.makedirs(os.path.dirname(output_path), exist_ok=True)
+		temporary = output_path + '.tmp'
+		with open(temporary, 'w', encoding='utf-8') as f:
+			f.write(html_content)
+		os.replace(temporary, output_path)
+		self.manifest.update(relative_path, source_path, hashlib.sha256(data).hexdigest())
+		return len(data)
+
+	def remove_stale_outputs(self, sources):
+		# Outputs of the sources which have been deleted since the last run
+		removed = 0
+		for relative_path in set(self.manifest.entries) - set(sources):
+			try:
+				os.remove(os.path.join(self.output_dir, get_output_name(relative_path)))
+				removed = removed + 1
+			except OSError:
+				pass
+			self.manifest.remove(relative_path)
+		return removed
+
+	def run(self, on_file_done=None):
+		# Returns a summary; `on_file_done(relative_path, size, error)` is called
+		# from the worker threads after each source.
+		start = time.monotonic()
+		excluded = self.output_dir if self.output_dir != self.source_dir else None
+		sources = find_sources(self.source_dir, excluded)
+		os.makedirs(self.output_dir, exist_ok=True)
+		removed = self.remove_stale_outputs(sources)
+		sizes = {}
+		for relative_path, error in find_collisions(sources).items():
+			self.errors[relative_path] = error
+			self.manifest.remove(relative_path)
+			if on_file_done is not None:
+				on_file_done(relative_path, None, error)
+		def render(relative_path):
+			size = None
+			error = None
+			try:
+				size = self.render_file(relative_path)
+			except Exception as e:
+				error = str(e).strip() or e.__class__.__name__
+				self.errors[relative_path] = error
+				self.manifest.remove(relative_path)
+			sizes[relative_path] = size
+			if on_file_done is not None:
+				on_file_done(relative_path, size, error)
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			list(executor.map(render, [path for path in sources if path not in self.errors]))
+		self.manifest.save()
+		elapsed = time.monotonic() - start
+		rendered = [size for path, size in sizes.items() if size is not None]
+		total_bytes = sum(rendered)
+		return {
+			'sources': len(sources),
+			'rendered': len(rendered),
+			'skipped': len(sources) - len(rendered) - len(self.errors),
+			'failed': len(self.errors),
+			'removed': removed,
+			'bytes': total_bytes,
+			'elapsed': elapsed,
+			'files_per_second': len(rendered) / elapsed if elapsed > 0 else 0,
+			'megabytes_per_second': total_bytes / 1024 / 1024 / elapsed if elapsed > 0 else 0,
+		}
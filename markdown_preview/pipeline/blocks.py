@@ -0,0 +1,235 @@
+import bisect
+import json
+import re
+
+# Incremental rendering: the Markdown source is split into top-level blocks,
+# and LaTeX sources into sections, which are converted separately (and cached
+# by content), then patched into the page already displayed instead of
+# reloading it.
+
+SEPARATOR = '<!-- markdown-preview-block -->'
+
+FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+LIST_RE = re.compile(r'^ {0,3}([-+*]|\d+[.)])\s')
+# Reference links, footnotes and metadata blocks make a block's output depend on
+# the rest of the document, so such documents are always rendered as a whole.
+GLOBAL_RE = re.compile(r'^ {0,3}\[[^\]]+\]:|\[\^[^\]]+\]|\A---\s*$|\A%', re.MULTILINE)
+# Same for LaTeX: footnotes are gathered at the end of pandoc's output, and a
+# table of contents or a bibliography depends on every section.
+LATEX_GLOBAL_RE = re.compile(r'\\(footnote|tableofcontents|bibliography|printbibliography)\b')
+
+def needs_full_render(text, from_format='markdown'):
+	if from_format == 'latex':
+		return LATEX_GLOBAL_RE.search(text) is not None
+	return GLOBAL_RE.search(text) is not None
+
+def split_blocks(text):
+	return [block_text for block_text, offset, line in locate_blocks(text)]
+
+def locate_blocks(text):
+	# (text, offset, line) of each block: where its first line starts in the
+	# source, and the number of that line (counted from 1).
+	blocks = []
+	current = []
+	fence = None
+	offset = 0
+	for number, line in enumerate(text.split('\n')):
+		if fence is not None:
+			current.append(line)
+			if line.strip().startswith(fence):
+				fence = None
+		else:
+			match = FENCE_RE.match(line)
+			if match:
+				fence = match.group(1)
+			if match or line.strip() != '':
+				if len(current) == 0:
+					blocks.append((current, offset, number + 1))
+				current.append(line)
+			else:
+				current = []
+		offset = offset + len(line) + 1
+
+	# Indented blocks continue the previous one (loose lists, nested content),
+	# and consecutive list items belong to the same list.
+	merged = []
+	for block, offset, line in blocks:
+		first = block[0]
+		if len(merged) > 0 and (first[:1] in (' ', '\t') or \
+		                 (LIST_RE.match(first) and LIST_RE.match(merged[-1][0][0]))):
+			merged[-1] = (merged[-1][0] + [''] + block, merged[-1][1], merged[-1][2])
+		else:
+			merged.append((block, offset, line))
+	return [('\n'.join(block), offset, line) for block, offset, line in merged]
+
+def join_blocks(blocks):
+	return ('\n\n' + SEPARATOR + '\n\n').join(blocks)
+
+def split_output(html, count):
+	# None if the blocks couldn't be told apart in pandoc's output.
+	parts = html.split(SEPARATOR)
+	if len(parts) != count:
+		return None
+	return [part.strip() for part in parts]
+
+# Pandoc drops comments from LaTeX, so sections are separated by a paragraph
+# it leaves as is.
+LATEX_SEPARATOR = 'markdownpreviewblockseparator'
+LATEX_SEPARATOR_RE = re.compile(r'<p>\s*' + LATEX_SEPARATOR + r'\s*</p>')
+SECTION_RE = re.compile(r'^\s*\\(part|chapter|section)\*?\s*[\[{]')
+ENVIRONMENT_RE = re.compile(r'\\(begin|end)\s*\{([^}]*)\}')
+COMMENT_RE = re.compile(r'(?<!\\)%.*')
+
+def split_latex(text):
+	# The preamble (macros) and the body, cut before each top-level section.
+	begin = text.find('\\begin{document}')
+	if begin < 0:
+		preamble = ''
+		body = text
+	else:
+		preamble = text[:begin]
+		body = text[begin + len('\\begin{document}'):]
+		end = body.find('\\end{document}')
+		if end >= 0:
+			body = body[:end]
+	sections = []
+	current = []
+	depth = 0
+	for line in body.split('\n'):
+		code = COMMENT_RE.sub('', line)
+		if depth == 0 and SECTION_RE.match(code) and len(current) > 0:
+			sections.append(current)
+			current = []
+		current.append(line)
+		for match in ENVIRONMENT_RE.finditer(code):
+			depth = depth + 1 if match.group(1) == 'begin' else max(0, depth - 1)
+	sections.append(current)
+	sections = ['\n'.join(section) for section in sections]
+	return preamble, [section for section in sections if section.strip() != '']
+
+def join_latex(preamble, sections):
+	body = ('\n\n' + LATEX_SEPARATOR + '\n\n').join(sections)
+	return preamble + '\\begin{document}\n' + body + '\n\\end{document}\n'
+
+def split_latex_output(html, count):
+	parts = LATEX_SEPARATOR_RE.split(html)
+	if len(parts) != count:
+		return None
+	return [part.strip() for part in parts]
+
+# Large documents are only rendered around a few lines (the cursor, the top of
+# the preview): the other blocks are replaced by empty placeholders of about
+# the same height, one for each run of blocks, so the page stays small.
+PLACEHOLDER_LINE_HEIGHT = 1.5 # em for each line of source
+
+def build_placeholder(block_texts):
+	height = sum(text.count('\n') + 2 for text in block_texts) * PLACEHOLDER_LINE_HEIGHT
+	return '<div class="mdp-placeholder" style="height: %.1fem"></div>' % height
+
+def window_blocks(block_texts, lines, centers, max_bytes):
+	# Returns (text, line, placeholder) items, where either the text of a block
+	# or the placeholder of a run of blocks is None, and the line ranges of the
+	# placeholders. Around each center, up to max_bytes of source are kept on
+	# each side.
+	selected = set()
+	for center in centers:
+		index = max(0, bisect.bisect_right(lines, center) - 1)
+		for step in (-1, 1):
+			size = 0
+			i = index if step == -1 else index + 1
+			while 0 <= i < len(block_texts) and size < max_bytes:
+				selected.add(i)
+				size = size + len(block_texts[i])
+				i = i + step
+	items = []
+	ranges = []
+	run = []
+	for i in range(len(block_texts) + 1):
+		if i < len(block_texts) and i not in selected:
+			run.append(i)
+			continue
+		if len(run) > 0:
+			texts = [block_texts[j] for j in run]
+			items.append((None, lines[run[0]], build_placeholder(texts)))
+			ranges.append((lines[run[0]], lines[run[-1]] + texts[-1].count('\n')))
+			run = []
+		if i < len(block_texts):
+			items.append((block_texts[i], lines[i], None))
+	return items, ranges
+
+def wrap_block(key, html, line):
+	# 'display: contents' keeps the wrapper out of the layout. The line of the
+	# source is used to synchronize the scrolling.
+	return '<div class="mdp-block" style="display: contents" data-hash="' + key + \
+		'" data-source-line="' + str(line) + '">' + html + '</div>'
+
+PATCH_FUNCTION = '''(function (items) {
+	var body = document.body;
+	var existing = {};
+	var nodes = body.querySelectorAll(':scope > div.mdp-block');
+	for (var i = 0; i < nodes.length; i++) {
+		var h = nodes[i].dataset.hash;
+		(existing[h] = existing[h] || []).push(nodes[i]);
+	}
+	var seen = {};
+	var previous = null;
+	for (var i = 0; i < items.length; i++) {
+		var h = items[i].h;
+		var node = existing[h] ? existing[h].shift() : undefined;
+		if (!node && items[i].html === undefined && seen[h]) {
+			node = seen[h].cloneNode(true);
+		} else if (!node) {
+			node = document.createElement('div');
+			node.className = 'mdp-block';
+			node.style.display = 'contents';
+			node.dataset.hash = h;
+			node.innerHTML = items[i].html;
+		}
+		node.dataset.sourceLine = items[i].l;
+		seen[h] = node;
+		body.insertBefore(node, previous ? previous.nextSibling : body.firstChild);
+		previous = node;
+	}
+	for (var h in existing) {
+		for (var i = 0; i < existing[h].length; i++) {
+			existing[h][i].remove();
+		}
+	}
+	if (window.mdpInvalidate) {
+		window.mdpInvalidate();
+	}
+})'''
+
+def build_patch_script(keys, lines, contents, displayed):
+	# Only blocks which aren't in the page yet are sent with their html.
+	items = []
+	for key, line in zip(keys, lines):
+		if key in displayed:
+			items.append({'h': key, 'l': line})
+		else:
+			items.append({'h': key, 'l': line, 'html': contents[key]})
+	return PATCH_FUNCTION + '(' + json.dumps(items) + ');'
+
+class BlocksJob:
+	# Converts several blocks with a single render job, then splits the output.
+
+	def __init__(self, job, count, split=split_output):
+		self.job = job
+		self.count = count
+		self.split = split
+		self.result = None
+		self.error = None
+		self.elapsed = 0
+		self.timings = job.timings
+
+	def run(self):
+		html = self.job.run()
+		if html is None:
+			return None
+		parts = self.split(html, self.count)
+		if parts is None:
+			raise ValueError("the blocks can't be told apart in the output")
+		return parts
+
+	def cancel(self):
+		self.job.cancel()
@@ -0,0 +1,165 @@
+import collections
+import hashlib
+import os
+import threading
+import time
+
+def make_key(*parts):
+	# Content-addressed: the key only depends on what the output depends on.
+	h = hashlib.sha256()
+	for part in parts:
+		h.update(str(part).encode('utf-8'))
+		h.update(b'\0')
+	return h.hexdigest()
+
+class RenderCache:
+	# An LRU cache of rendered HTML, bounded by the size of its entries. An
+	# optional second tier keeps entries on disk, so large documents are cheap to
+	# reopen after a restart. The disk is only accessed from worker threads.
+
+	DISK_PRUNE_INTERVAL = 32 # writes
+
+	def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self.max_bytes = max_bytes
+		self.size = 0
+		self.disk_dir = disk_dir
+		self.disk_max_bytes = disk_max_bytes
+		self._disk_writes = 0
+		self.hits = 0
+		self.misses = 0
+		self.disk_hits = 0
+		self.evictions = 0
+
+	def get(self, key):
+		with self._lock:
+			value = self._entries.get(key)
+			if value is None:
+				self.misses = self.misses + 1
+				return None
+			self._entries.move_to_end(key)
+			self.hits = self.hits + 1
+			return value
+
+	def put(self, key, value):
+		with self._lock:
+			if key in self._entries:
+				self.size = self.size - len(self._entries.pop(key))
+			if len(value) > self.max_bytes:
+				return
+			self._entries[key] = value
+			self.size = self.size + len(value)
+			self._evict()
+
+	def set_max_bytes(self, max_bytes):
+		with self._lock:
+			self.max_bytes = max_bytes
+			self._evict()
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.size = 0
+
+	def get_stats(self):
+		return {
+			'entries': len(self._entries),
+			'size': self.size,
+			'hits': self.hits,
+			'misses': self.misses,
+			'disk_hits': self.disk_hits,
+			'evictions': self.evictions,
+		}
+
+	def _evict(self):
+		while self.size > self.max_bytes:
+			key, value = self._entries.popitem(last=False)
+			self.size = self.size - len(value)
+			self.evictions = self.evictions + 1
+
+	############################################################################
+
+	def load_from_disk(self, key):
+		if self.disk_dir is None:
+			return None
+		try:
+			with open(self._get_disk_path(key), 'r', encoding='utf-8') as f:
+				value = f.read()
+		except OSError:
+			return None
+		self.disk_hits = self.disk_hits + 1
+		self.put(key, value)
+		return value
+
+	def store_on_disk(self, key, value):
+		if self.disk_dir is None:
+			return
+		path = self._get_disk_path(key)
+		try:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			# Written aside then renamed, so a reader never sees half an entry.
+			with open(path + '.part', 'w', encoding='utf-8') as f:
+				f.write(value)
+			os.replace(path + '.part', path)
+		except OSError:
+			return
+		self._disk_writes = self._disk_writes + 1
+		if self._disk_writes % self.DISK_PRUNE_INTERVAL == 0:
+			self._prune_disk()
+
+	def store_in_background(self, key, value):
+		if self.disk_dir is None:
+			return
+		thread = threading.Thread(target=self.store_on_disk, args=(key, value), daemon=True)
+		thread.start()
+
+	def _get_disk_path(self, key):
+		return os.path.join(self.disk_dir, key[:2], key + '.html')
+
+	def _prune_disk(self):
+		# The least recently written entries are removed first.
+		files = []
+		for root, dirs, names in os.walk(self.disk_dir):
+			for name in names:
+				path = os.path.join(root, name)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				files.append((stat.st_mtime, stat.st_size, path))
+		total = sum(f[1] for f in files)
+		for mtime, size, path in sorted(files):
+			if total <= self.disk_max_bytes:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total = total - size
+
+class CachedJob:
+	# Wraps a render job: before running it, the disk tier of the cache is
+	# checked. Both happen on the worker thread.
+
+	def __init__(self, cache, key, job):
+		self.cache = cache
+		self.key = key
+		self.job = job
+		self.from_cache = False
+		self.result = None
+		self.error = None
+		self.elapsed = 0
+		self.timings = job.timings
+
+	def run(self):
+		start = time.monotonic()
+		value = self.cache.load_from_disk(self.key)
+		if value is not None:
+			self.from_cache = True
+			self.timings = {'cache': time.monotonic() - start}
+			return value
+		return self.job.run()
+
+	def cancel(self):
+		self.job.cancel()
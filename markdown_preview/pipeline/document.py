@@ -0,0 +1,24 @@
+# What the preview does with a document, apart from displaying it. `doc` can be
+# a Gedit.Document or anything with the same methods (benchmarks, batch mode).
+
+# Recognized extensions, and the matching pandoc input formats
+FORMATS = {'md': 'markdown', 'html': 'html', 'tex': 'latex'}
+
+def detect_format(name):
+	extension = name.split('.')[-1]
+	if extension in FORMATS:
+		return extension
+	return 'error'
+
+def read_buffer(doc):
+	start, end = doc.get_bounds()
+	return doc.get_text(start, end, True)
+
+def wrap_html(html_string, style=None):
+	if style is None:
+		pre_string = '<html><head><meta charset="utf-8" /></head><body>'
+	else:
+		pre_string = '<html><head><meta charset="utf-8" /><link rel="stylesheet" href="' + \
+			style + '" /></head><body>'
+	post_string = '</body></html>'
+	return pre_string + html_string + post_string
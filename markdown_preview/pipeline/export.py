@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .batch import get_file_hash
+from .cache import make_key
+
+class PdfLatexJob:
+	# pdflatex run on a saved .tex file, in a build directory of its own so the
+	# auxiliary files are kept between builds without cluttering the source
+	# folder. The pdf is then copied next to the source. When neither the file
+	# nor the files it includes have changed since the last build, pdflatex
+	# isn't run at all.
+
+	INPUT_RE = re.compile(r'\\(?:input|include)\s*\{([^}]+)\}')
+
+	def __init__(self, input_path, build_dir):
+		self.input_path = input_path
+		self.build_dir = build_dir
+		self.result = None
+		self.error = None
+		self.elapsed = 0
+		self.timings = {}
+		self._process = None
+		self._cancelled = False
+		self._lock = threading.Lock()
+
+	def get_output_path(self):
+		return os.path.splitext(self.input_path)[0] + '.pdf'
+
+	def get_inputs_hash(self):
+		directory = os.path.dirname(self.input_path)
+		h = hashlib.sha256()
+		with open(self.input_path, 'rb') as f:
+			source = f.read()
+		h.update(source)
+		for name in self.INPUT_RE.findall(source.decode('utf-8', 'replace')):
+			path = os.path.join(directory, name.strip())
+			if not os.path.splitext(path)[1]:
+				path = path + '.tex'
+			try:
+				with open(path, 'rb') as f:
+					h.update(f.read())
+			except OSError:
+				pass
+		return h.hexdigest()
+
+	def run(self):
+		start = time.monotonic()
+		directory = os.path.dirname(self.input_path)
+		name = os.path.splitext(os.path.basename(self.input_path))[0]
+		built_path = os.path.join(self.build_dir, name + '.pdf')
+		stamp_path = os.path.join(self.build_dir, name + '.sha256')
+		os.makedirs(self.build_dir, exist_ok=True)
+		digest = self.get_inputs_hash()
+		try:
+			with open(stamp_path, 'r') as f:
+				up_to_date = (f.read() == digest) and os.path.exists(built_path)
+		except OSError:
+			up_to_date = False
+		if not up_to_date:
+			self._build(directory)
+			if self._cancelled:
+				return None
+			with open(stamp_path, 'w') as f:
+				f.write(digest)
+		self.timings['pdflatex'] = time.monotonic() - start
+		shutil.copyfile(built_path, self.get_output_path())
+		return self.get_output_path()
+
+	def _build(self, directory):
+		# Relative paths (pictures, included files) are resolved from the source folder
+		with self._lock:
+			if self._cancelled:
+				return
+			self._process = subprocess.Popen(['pdflatex', '-interaction=nonstopmode', \
+				'-halt-on-error', '-output-directory', self.build_dir, self.input_path], \
+				cwd=directory, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, \
+				stderr=subprocess.STDOUT)
+		stdout, stderr = self._process.communicate()
+		if self._process.returncode != 0 and not self._cancelled:
+			# pdflatex explains its errors in its log, i.e. on stdout
+			raise RuntimeError(stdout.decode('utf-8', 'replace')[-2000:])
+
+	def cancel(self):
+		with self._lock:
+			self._cancelled = True
+			if self._process is not None and self._process.poll() is None:
+				self._process.kill()
+
+class ExportRecord:
+	# What produced each exported file: the hash of its source and the name of
+	# the producer (e.g. the backend), with the size and modification time of
+	# the output once written. An output is only up to date if it's still the
+	# file which was written, from the same source, by the same producer. The
+	# file is only read by the first export, on an export thread.
+
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._entries = None
+
+	def _get_entries(self):
+		with self._lock:
+			if self._entries is None:
+				try:
+					with open(self.path, 'r', encoding='utf-8') as f:
+						self._entries = json.load(f)
+				except (OSError, ValueError):
+					self._entries = {}
+			return self._entries
+
+	def get_stamp(self, task):
+		return make_key(get_file_hash(task.input_path), task.producer)
+
+	def is_up_to_date(self, task):
+		entry = self._get_entries().get(task.output_path)
+		try:
+			stat = os.stat(task.output_path)
+			return entry is not None and entry['mtime'] == stat.st_mtime and \
+				entry['size'] == stat.st_size and entry['stamp'] == self.get_stamp(task)
+		except OSError:
+			return False
+
+	def update(self, task):
+		try:
+			stat = os.stat(task.output_path)
+			entry = {'stamp': self.get_stamp(task), 'mtime': stat.st_mtime, 'size': stat.st_size}
+		except OSError:
+			return
+		entries = self._get_entries()
+		with self._lock:
+			entries[task.output_path] = entry
+			try:
+				os.makedirs(os.path.dirname(self.path), exist_ok=True)
+				temporary = self.path + '.tmp'
+				with open(temporary, 'w', encoding='utf-8') as f:
+					json.dump(entries, f)
+				os.replace(temporary, self.path)
+			except OSError:
+				pass
+
+class ExportTask:
+	# One file to export. `state` is 'queued', 'running', 'done', 'skipped',
+	# 'failed' or 'cancelled'. `producer` tells what makes the output, for the
+	# export record.
+
+	def __init__(self, job, input_path, output_path, producer=None):
+		self.job = job
+		self.input_path = input_path
+		self.output_path = output_path
+		self.producer = producer
+		self.skip_unchanged = False
+		self.state = 'queued'
+		self.error = None
+		self._future = None
+
+	def is_finished(self):
+		return self.state not in ('queued', 'running')
+
+class ExportQueue:
+	# Exports run in the background, at most `max_workers` at the same time, so a
+	# batch of documents is spread over the CPU cores. `callback(task)` is called
+	# on the main loop each time a task changes state. `dispatch` has to call its
+	# arguments on the main loop (e.g. GLib.idle_add). With a `record`, exports
+	# are recorded, so the unchanged ones can be skipped.
+
+	def __init__(self, dispatch, callback, max_workers=None, record=None):
+		self._dispatch = dispatch
+		self._callback = callback
+		self._max_workers = max_workers or os.cpu_count() or 1
+		self.record = record
+		self._executor = None
+		self._lock = threading.Lock()
+		self.tasks = []
+
+	def submit(self, task, skip_unchanged=False):
+		# With `skip_unchanged`, an output recorded as made from the same source
+		# by the same producer isn't exported again.
+		if self._executor is None:
+			self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+		if not self.is_busy():
+			self.tasks = [] # a new batch starts
+		self.tasks.append(task)
+		task.skip_unchanged = skip_unchanged and self.record is not None and \
+			task.producer is not None
+		task._future = self._executor.submit(self._run, task)
+		self._callback(task)
+
+	def cancel(self):
+		with self._lock:
+			for task in self.tasks:
+				if task.is_finished():
+					continue
+				task.state = 'cancelled'
+				if task._future is not None:
+					task._future.cancel()
+				task.job.cancel()
+		self._callback(None)
+
+	def get_progress(self):
+		finished = len([task for task in self.tasks if task.is_finished()])
+		return (finished, len(self.tasks))
+
+	def is_busy(self):
+		finished, total = self.get_progress()
+		return finished < total
+
+	def shutdown(self):
+		self.cancel()
+		if self._executor is not None:
+			self._executor.shutdown(wait=False)
+		self._executor = None
+
+	def _run(self, task):
+		with self._lock:
+			if task.state != 'queued':
+				return
+			task.state = 'running'
+		self._dispatch(self._deliver, task)
+		try:
+			if task.skip_unchanged and self.record.is_up_to_date(task):
+				with self._lock:
+					if task.state == 'running':
+						task.state = 'skipped'
+				self._dispatch(self._deliver, task)
+				return
+			task.job.result = task.job.run()
+		except Exception as e:
+			task.job.error = e
+		with self._lock:
+			if task.state == 'running':
+				if task.job.error is not None:
+					task.state = 'failed'
+					task.error = str(task.job.error).strip()
+				else:
+					task.state = 'done'
+		if task.state == 'done' and self.record is not None and task.producer is not None:
+			self.record.update(task)
+		self._dispatch(self._deliver, task)
+
+	def _deliver(self, task):
+		self._callback(task)
+		return False
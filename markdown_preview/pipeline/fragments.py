@@ -0,0 +1,146 @@
+import re
+import time
+
+from .blocks import join_blocks, split_output
+from .cache import make_key
+
+# Fenced code blocks (highlighted by pandoc) and formulas (rendered as MathML)
+# are converted apart from the rest of the text, and cached by content, so an
+# edit elsewhere doesn't convert them again. The text is converted with a
+# comment in their place, and the cached fragments are spliced into the output.
+
+MARKER_RE = re.compile(r'<!--mdp-fragment:([0-9a-f]{64})-->')
+FENCE_RE = re.compile(r'^( {0,3})(`{3,}|~{3,})')
+# Lines of indented code (or of indented fences, or of nested content, which
+# is left alone to be safe)
+INDENTED_RE = re.compile(r'^( {4,}|\t)')
+# Code spans, comments and raw html whose content is literal are matched first,
+# so the dollars they contain are left alone.
+MATH_RE = re.compile(r'(?P<literal>(`+)[\s\S]*?(?<!`)\2(?!`)|<!--[\s\S]*?-->|' \
+	r'<(pre|code|script|style|textarea)\b[\s\S]*?</\3\s*>)|\$\$([\s\S]+?)\$\$|' \
+	r'(?<![\\$\w])\$(?![\s$])((?:[^$\\\n]|\\.)+?)(?<![\s\\])\$(?!\d)', re.IGNORECASE)
+
+def build_marker(key):
+	return '<!--mdp-fragment:' + key + '-->'
+
+def extract_fragments(text):
+	# Returns the text with markers, and the fragments as {key: source}, where
+	# the source is what pandoc has to convert alone.
+	fragments = {}
+	lines = text.split('\n')
+	output = []
+	chunk = []
+	i = 0
+	while i < len(lines):
+		match = FENCE_RE.match(lines[i])
+		end = None
+		if match:
+			indent, fence = match.groups()
+			end = i + 1
+			while end < len(lines) and not (lines[end].strip().startswith(fence) and \
+			                        lines[end].strip().strip(fence[0]) == ''):
+				end = end + 1
+		if end is None or end >= len(lines):
+			# Not a code block, or one which is never closed
+			chunk.append(lines[i])
+			i = i + 1
+			continue
+		output.append(_extract_math('\n'.join(chunk), fragments))
+		chunk = []
+		source = '\n'.join(line[len(indent):] for line in lines[i:end + 1])
+		key = make_key('code', source)
+		fragments[key] = source
+		output.append(indent + build_marker(key))
+		i = end + 1
+	output.append(_extract_math('\n'.join(chunk), fragments))
+	return '\n'.join(part for part in output), fragments
+
+def _extract_math(text, fragments):
+	def replace(match):
+		if match.group('literal') is not None:
+			return match.group(0)
+		source = match.group(0)
+		key = make_key('math', source)
+		fragments[key] = source
+		return build_marker(key)
+	# Indented lines are kept as they are, and formulas are only looked for in
+	# the runs of other lines.
+	parts = []
+	run = []
+	indented = False
+	for line in text.split('\n'):
+		line_indented = INDENTED_RE.match(line) is not None
+		if line_indented != indented and len(run) > 0:
+			parts.append(_join_run(run, indented, replace))
+			run = []
+		indented = line_indented
+		run.append(line)
+	parts.append(_join_run(run, indented, replace))
+	return '\n'.join(parts)
+
+def _join_run(lines, indented, replace):
+	text = '\n'.join(lines)
+	return text if indented else MATH_RE.sub(replace, text)
+
+def _unwrap_paragraph(html):
+	# A formula converted alone is a paragraph of its own
+	if html.startswith('<p>') and html.endswith('</p>'):
+		return html[3:-4]
+	return html
+
+class FragmentJob:
+	# Converts the fragments which aren't cached yet (all at once), then the
+	# text, and splices them. If the fragments can't be told apart in pandoc's
+	# output, `fallback` (the conversion of the original text) is used instead.
+	# `build_job(text)` returns the job converting the fragments.
+
+	def __init__(self, job, fragments, cache, build_job, fallback):
+		self.job = job
+		self.fragments = fragments
+		self.cache = cache
+		self.build_job = build_job
+		self.fallback = fallback
+		self.result = None
+		self.error = None
+		self.elapsed = 0
+		self.timings = job.timings
+		self._current = None
+		self._cancelled = False
+
+	def run(self):
+		start = time.monotonic()
+		contents = {}
+		missing = []
+		for key in self.fragments:
+			contents[key] = self.cache.get(key)
+			if contents[key] is None:
+				missing.append(key)
+		if len(missing) > 0:
+			sources = [self.fragments[key] for key in missing]
+			self._current = self.build_job(join_blocks(sources))
+			html = None if self._cancelled else self._current.run()
+			if self._cancelled or html is None:
+				return None
+			parts = split_output(html, len(missing))
+			if parts is None:
+				self._current = self.fallback
+				return None if self._cancelled else self.fallback.run()
+			for key, part in zip(missing, parts):
+				contents[key] = _unwrap_paragraph(part)
+				self.cache.put(key, contents[key])
+		self.timings['fragments'] = time.monotonic() - start
+		self._current = self.job
+		html = None if self._cancelled else self.job.run()
+		if html is None:
+			return None
+		if set(MARKER_RE.findall(html)) != set(self.fragments):
+			# Some markers were escaped or dropped by pandoc (e.g. in raw
+			# contexts): they can't be replaced.
+			self._current = self.fallback
+			return None if self._cancelled else self.fallback.run()
+		return MARKER_RE.sub(lambda match: contents.get(match.group(1), ''), html)
+
+	def cancel(self):
+		self._cancelled = True
+		if self._current is not None:
+			self._current.cancel()
@@ -0,0 +1,190 @@
+import html
+import os
+import queue
+import re
+import threading
+import urllib.parse
+
+from .cache import make_key
+
+# Pictures are displayed in a narrow panel, so the preview uses copies scaled
+# down to its width, kept on disk and keyed by the path, modification time and
+# size of the original. The html given to the preview is rewritten to use them,
+# and to load pictures lazily; exports still use the originals.
+
+IMG_RE = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+SRC_RE = re.compile(r'\ssrc=(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+ORIGINAL_RE = re.compile(r'\sdata-mdp-original=(?:"([^"]*)"|\'([^\']*)\')')
+# Other formats are vectorial or animated, so they're left as they are.
+SCALED_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.webp': 'png', \
+	'.bmp': 'png', '.tif': 'png', '.tiff': 'png'}
+WIDTH_STEP = 256 # px, so a few pixels more or less don't require new copies
+
+def get_width_bucket(width):
+	return max(1, (width + WIDTH_STEP - 1) // WIDTH_STEP) * WIDTH_STEP
+
+def resolve_src(src, base_dir):
+	# The local path of a picture, or None if it's remote or embedded
+	src = html.unescape(src)
+	if src.startswith('file://'):
+		return urllib.parse.unquote(urllib.parse.urlparse(src).path)
+	if re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', src):
+		return None
+	path = urllib.parse.unquote(src)
+	if not os.path.isabs(path):
+		if base_dir is None:
+			return None
+		path = os.path.join(base_dir, path)
+	return os.path.normpath(path)
+
+def find_pictures(html_string, base_dir):
+	# The local pictures of a page, whether it's been rewritten or not
+	paths = set()
+	for tag in IMG_RE.findall(html_string):
+		match = ORIGINAL_RE.search(tag) or SRC_RE.search(tag)
+		if match is not None:
+			paths.add(resolve_src(match.group(1) if match.group(1) is not None \
+				else match.group(2), base_dir))
+	paths.discard(None)
+	return paths
+
+class ThumbnailCache:
+	# Scaled copies are made by a background thread with GdkPixbuf (which is
+	# only imported there); `on_created(original_uri, thumbnail_uri)` is then
+	# called through `dispatch`, e.g. to update the page.
+
+	PRUNE_INTERVAL = 32 # thumbnails
+
+	def __init__(self, directory, max_bytes, dispatch, on_created):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self._dispatch = dispatch
+		self._on_created = on_created
+		self._queue = queue.Queue()
+		self._pending = set()
+		self._small = set()
+		self._lock = threading.Lock()
+		self._thread = None
+		self._created = 0
+		self.available = True
+
+	def get_thumbnail_path(self, path, width):
+		# None if there is no original, or if it isn't worth scaling
+		extension = os.path.splitext(path)[1].lower()
+		if not self.available or extension not in SCALED_FORMATS:
+			return None
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		key = make_key(path, stat.st_mtime, stat.st_size, width)
+		if key in self._small:
+			return None
+		return os.path.join(self.directory, key + '.' + SCALED_FORMATS[extension])
+
+	def rewrite(self, html_string, base_dir, width):
+		width = get_width_bucket(width)
+		def replace_img(match):
+			tag = match.group(0)
+			src_match = SRC_RE.search(tag)
+			if src_match is None or 'data-mdp-original' in tag:
+				return tag
+			src = src_match.group(1) if src_match.group(1) is not None else src_match.group(2)
+			path = resolve_src(src, base_dir)
+			if path is None:
+				# Remote or embedded: it can still be loaded lazily
+				if 'loading=' in tag:
+					return tag
+				return tag[:src_match.end()] + ' loading="lazy"' + tag[src_match.end():]
+			original_uri = 'file://' + urllib.parse.quote(path)
+			new_src = self.get_src(path, width)
+			attributes = ' src="' + html.escape(new_src) + '" data-mdp-original="' + \
+				html.escape(original_uri) + '" loading="lazy" decoding="async"'
+			return tag[:src_match.start()] + attributes + tag[src_match.end():]
+		return IMG_RE.sub(replace_img, html_string)
+
+	def get_src(self, path, width):
+		# The uri of the scaled copy of a local picture if it's ready, or else of
+		# the original (the copy is then requested).
+		original_uri = 'file://' + urllib.parse.quote(path)
+		width = get_width_bucket(width)
+		thumbnail = self.get_thumbnail_path(path, width)
+		if thumbnail is None:
+			return original_uri
+		if os.path.exists(thumbnail):
+			return 'file://' + urllib.parse.quote(thumbnail)
+		self._request(path, thumbnail, width, original_uri)
+		return original_uri
+
+	def _request(self, path, thumbnail, width, original_uri):
+		with self._lock:
+			if thumbnail in self._pending:
+				return
+			self._pending.add(thumbnail)
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, daemon=True)
+				self._thread.start()
+		self._queue.put((path, thumbnail, width, original_uri))
+
+	def _run(self):
+		try:
+			import gi
+			gi.require_version('GdkPixbuf', '2.0')
+			from gi.repository import GdkPixbuf
+		except (ImportError, ValueError):
+			self.available = False
+			return
+		os.makedirs(self.directory, exist_ok=True)
+		while True:
+			path, thumbnail, width, original_uri = self._queue.get()
+			try:
+				created = self._create(GdkPixbuf, path, thumbnail, width)
+			except Exception:
+				# Not readable by GdkPixbuf: the original is used
+				self._small.add(os.path.basename(thumbnail).split('.')[0])
+				created = False
+			with self._lock:
+				self._pending.discard(thumbnail)
+			if created:
+				self._dispatch(self._deliver, original_uri, 'file://' + urllib.parse.quote(thumbnail))
+
+	def _create(self, GdkPixbuf, path, thumbnail, width):
+		info, original_width, original_height = GdkPixbuf.Pixbuf.get_file_info(path)
+		if info is None or original_width <= width:
+			# Already small enough
+			self._small.add(os.path.basename(thumbnail).split('.')[0])
+			return False
+		pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, width, -1, True)
+		pixbuf_format = os.path.splitext(thumbnail)[1][1:]
+		# Written under another name first, so a partial file is never used
+		temporary = thumbnail + '.tmp'
+		pixbuf.savev(temporary, pixbuf_format, [], [])
+		os.replace(temporary, thumbnail)
+		self._created = self._created + 1
+		if self._created % self.PRUNE_INTERVAL == 0:
+			self._prune()
+		return True
+
+	def _deliver(self, original_uri, thumbnail_uri):
+		self._on_created(original_uri, thumbnail_uri)
+		return False
+
+	def _prune(self):
+		# The least recently modified thumbnails go first
+		entries = []
+		for name in os.listdir(self.directory):
+			path = os.path.join(self.directory, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+		total = sum(size for mtime, size, path in entries)
+		for mtime, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+				total = total - size
+			except OSError:
+				pass
@@ -0,0 +1,47 @@
+from .backends import choose_backend
+from .cache import CachedJob
+from .document import wrap_html
+from .fragments import FragmentJob, extract_fragments
+from .sourcemap import add_line_markers
+
+# How a text is converted, from the source to the page kept in the cache. The
+# preview, the batch renderer and the benchmarks all go through these, so they
+# run the same jobs.
+
+def prepare_text(from_format, text, line_markers):
+	# The source lines are marked in the output, for the scroll synchronization
+	if from_format == 'markdown' and line_markers:
+		return add_line_markers(text)
+	return text
+
+def build_render_job(backend_name, from_format, args, text, server=None, fragment_cache=None):
+	# The chosen backend is used if it supports this text, or else pandoc
+	backend = choose_backend(backend_name, from_format, text)
+	if from_format == 'markdown' and backend.name == 'pandoc':
+		# Formulas are rendered the same way, whether they're converted apart or not
+		args = args + ['--mathml']
+	if from_format == 'markdown' and backend.name == 'pandoc' and fragment_cache is not None:
+		# Code blocks and formulas are converted apart, and cached
+		stripped, fragments = extract_fragments(text)
+		if len(fragments) > 0:
+			return FragmentJob(backend.build_job(from_format, args, stripped, server), \
+				fragments, fragment_cache, \
+				lambda source: backend.build_job(from_format, args, source, server), \
+				backend.build_job(from_format, args, text, server))
+	return backend.build_job(from_format, args, text, server)
+
+def build_cached_job(cache, key, backend_name, from_format, args, text, server=None, \
+                                             fragment_cache=None, split_pages=False):
+	# With split_pages, the current page is cut from the html code after the
+	# conversion, for formats which can't be split before.
+	job = CachedJob(cache, key, build_render_job(backend_name, from_format, args, text, \
+		server, fragment_cache))
+	job.split_pages = split_pages
+	return job
+
+def store_render(cache, key, html_string):
+	# Returns the page to load, which is also kept in both tiers of the cache
+	html_content = wrap_html(html_string)
+	cache.put(key, html_content)
+	cache.store_in_background(key, html_content)
+	return html_content
@@ -0,0 +1,109 @@
+import bisect
+import re
+from html.parser import HTMLParser
+
+# Searching in the preview: the text of the rendered page is indexed once, so
+# matches are counted without the web process (and without a limit), and each
+# of them can be traced back to a line of the source.
+
+BLOCK_TAGS = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'pre', 'blockquote', \
+	'td', 'th', 'dt', 'dd', 'figcaption', 'caption', 'tr', 'hr', 'br', 'div', 'section'}
+# MathML annotations hold the TeX source of formulas, which isn't displayed
+SKIPPED_TAGS = {'script', 'style', 'head', 'title', 'annotation', 'annotation-xml'}
+
+class _TextExtractor(HTMLParser):
+
+	def __init__(self):
+		HTMLParser.__init__(self)
+		self.blocks = []
+		self._current = []
+		self._skipped = 0
+
+	def handle_starttag(self, tag, attrs):
+		if tag in SKIPPED_TAGS:
+			self._skipped = self._skipped + 1
+		elif tag in BLOCK_TAGS:
+			self.end_block()
+
+	def handle_endtag(self, tag):
+		if tag in SKIPPED_TAGS:
+			self._skipped = max(0, self._skipped - 1)
+		elif tag in BLOCK_TAGS:
+			self.end_block()
+
+	def handle_data(self, data):
+		if self._skipped == 0:
+			self._current.append(data)
+
+	def end_block(self):
+		text = ' '.join(''.join(self._current).split())
+		if text != '':
+			self.blocks.append(text)
+		self._current = []
+
+class TextIndex:
+	# The text of a page, block by block (paragraphs, headings, items, cells).
+	# Matches are case-insensitive, like the search of the preview, and are
+	# given as offsets in `text`.
+
+	def __init__(self, html):
+		extractor = _TextExtractor()
+		extractor.feed(html)
+		extractor.close()
+		extractor.end_block()
+		self.blocks = extractor.blocks
+		self.text = '\n'.join(self.blocks)
+		self._folded = self.text.lower()
+		self._starts = []
+		offset = 0
+		for block in self.blocks:
+			self._starts.append(offset)
+			offset = offset + len(block) + 1
+		self._query = None
+		self._matches = []
+
+	def find(self, query):
+		# The result of the last query is kept for the navigation between matches
+		query = ' '.join(query.lower().split())
+		if query == self._query:
+			return self._matches
+		self._query = query
+		self._matches = []
+		if query == '':
+			return self._matches
+		position = self._folded.find(query)
+		while position >= 0:
+			self._matches.append(position)
+			position = self._folded.find(query, position + len(query))
+		return self._matches
+
+	def get_block_index(self, offset):
+		return bisect.bisect_right(self._starts, offset) - 1
+
+	def find_source_line(self, source, offset, length):
+		# The match is looked for in the source with as much of its surrounding
+		# text as possible (markup can be in the way), and if that fails, the
+		# source occurrence with the same rank is used.
+		block_index = self.get_block_index(offset)
+		block = self.blocks[block_index]
+		start = offset - self._starts[block_index]
+		folded_source = source.lower()
+		for width in (30, 15, 5):
+			snippet = block[max(0, start - width):start + length + width].lower()
+			position = folded_source.find(snippet)
+			if position >= 0 and folded_source.find(snippet, position + 1) < 0:
+				return source.count('\n', 0, position + min(width, start))
+		query = self._folded[offset:offset + length]
+		occurrences = [match.start() for match in re.finditer(re.escape(query), folded_source)]
+		if len(occurrences) == 0:
+			# Markup inside the match: its longest word will do
+			word = max(query.split(), key=len, default='')
+			if word == '':
+				return None
+			occurrences = [match.start() for match in re.finditer(re.escape(word), folded_source)]
+			if len(occurrences) == 0:
+				return None
+		rank = self._matches.index(offset) if offset in self._matches else 0
+		if len(occurrences) != len(self._matches):
+			rank = rank * len(occurrences) // max(1, len(self._matches))
+		return source.count('\n', 0, occurrences[min(rank, len(occurrences) - 1)])
@@ -0,0 +1,228 @@
+import atexit
+import http.client
+import json
+import socket
+import subprocess
+import threading
+import time
+
+from .worker import PandocJob, RenderLimitExceeded, get_limits, get_memory_args
+
+class ServerError(Exception):
+	pass
+
+class PandocServer:
+	# A resident `pandoc server` process, spoken to over HTTP on localhost, so a
+	# render doesn't pay for spawning pandoc and starting the Haskell runtime.
+	# It's started lazily (from a worker thread) and restarted if it dies; after
+	# too many failures in a row it gives up, and callers use one-shot pandoc.
+
+	STARTUP_TIMEOUT = 5 # s
+	REQUEST_TIMEOUT = 60 # s
+	MAX_FAILURES = 3
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._process = None
+		self._port = None
+		# Each process started has a new generation; requests failing because
+		# their process was killed on purpose aren't failures of the server.
+		self._generation = 0
+		self._killed_generation = None
+		self.failures = 0
+		self.restarts = 0
+		self.requests = 0
+
+	def is_usable(self):
+		return self.failures < self.MAX_FAILURES
+
+	def convert(self, text, from_format, to_format='html', timeout=None, job=None, options=None):
+		# With a `job`, the request can be aborted by cancelling the job.
+		# `options` are other fields of the request, e.g. html-math-method.
+		port, generation = self._ensure_running()
+		request = dict(options or {})
+		request.update({'text': text, 'from': from_format, 'to': to_format})
+		body = json.dumps(request)
+		try:
+			connection = http.client.HTTPConnection('127.0.0.1', port, \
+				timeout=timeout or self.REQUEST_TIMEOUT)
+			if job is not None and not job.set_connection(connection):
+				raise ServerError('cancelled')
+			connection.request('POST', '/', body.encode('utf-8'), \
+				{'Content-Type': 'application/json', 'Accept': 'application/json'})
+			response = connection.getresponse()
+			data = response.read().decode('utf-8')
+			connection.close()
+		except socket.timeout:
+			# Still busy with this document: the server is restarted, but it
+			# isn't counted as a failure of the server, nor are the requests of
+			# the other windows which were running on it.
+			with self._lock:
+				if generation == self._generation and self._process is not None \
+				                                  and self._process.poll() is None:
+					self._killed_generation = generation
+					self._process.kill()
+			if timeout is None:
+				self._on_failure()
+				raise ServerError('timed out')
+			raise RenderLimitExceeded('time')
+		except (OSError, http.client.HTTPException) as e:
+			if job is not None and job.is_cancelled():
+				raise ServerError('cancelled')
+			with self._lock:
+				restarted = (generation == self._killed_generation)
+			if not restarted:
+				self._on_failure()
+			raise ServerError(str(e))
+		self.requests = self.requests + 1
+		if response.status != 200:
+			# The server is fine (no restart needed), but it couldn't convert
+			# this document, e.g. because of its own time limit.
+			raise ServerError(data)
+		self.failures = 0
+		return json.loads(data)['output']
+
+	def check_health(self):
+		if self._process is None or self._process.poll() is not None:
+			return False
+		try:
+			connection = http.client.HTTPConnection('127.0.0.1', self._port, timeout=1)
+			connection.request('GET', '/version')
+			healthy = (connection.getresponse().status == 200)
+			connection.close()
+			return healthy
+		except (OSError, http.client.HTTPException):
+			return False
+
+	def stop(self):
+		with self._lock:
+			if self._process is not None and self._process.poll() is None:
+				self._process.terminate()
+				try:
+					self._process.wait(1)
+				except subprocess.TimeoutExpired:
+					self._process.kill()
+			self._process = None
+
+	def _ensure_running(self):
+		with self._lock:
+			if not self.is_usable():
+				raise ServerError("pandoc server is disabled after repeated failures")
+			if self._process is not None and self._process.poll() is None:
+				return self._port, self._generation
+			if self._process is not None:
+				self.restarts = self.restarts + 1
+			self._generation = self._generation + 1
+			self._port = self._find_free_port()
+			try:
+				# The memory limit of the thread starting it applies to the whole
+				# server: if it's exceeded, the server dies, and the render falls
+				# back to one-shot pandoc, which has the same limit. The server's
+				# own time limit would stop long conversions (2 s by default):
+				# they're limited by the render workers instead.
+				self._process = subprocess.Popen(['pandoc'] + get_memory_args(get_limits()[1]) + \
+					['server', '--port', str(self._port), '--timeout', str(self.REQUEST_TIMEOUT)], \
+					stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+			except OSError as e:
+				self.failures = self.MAX_FAILURES
+				raise ServerError(str(e))
+			deadline = time.monotonic() + self.STARTUP_TIMEOUT
+			while not self.check_health():
+				if self._process.poll() is not None or time.monotonic() > deadline:
+					# Probably a pandoc version without the server mode (< 2.18)
+					self._process.kill()
+					self._process = None
+					self.failures = self.failures + 1
+					raise ServerError("pandoc server didn't start")
+				time.sleep(0.05)
+			return self._port, self._generation
+
+	def _on_failure(self):
+		with self._lock:
+			self.failures = self.failures + 1
+			if self._process is not None and self._process.poll() is None:
+				self._process.kill()
+
+	def _find_free_port(self):
+		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		s.bind(('127.0.0.1', 0))
+		port = s.getsockname()[1]
+		s.close()
+		return port
+
+class ServerJob(PandocJob):
+	# Same as a PandocJob, but the conversion is done by the resident server when
+	# possible. The one-shot process is still used as a fallback.
+
+	def __init__(self, server, from_format, args, text):
+		PandocJob.__init__(self, args, text)
+		self._server = server
+		self._from_format = from_format
+		self._connection = None
+		self._options = {}
+		if '--mathml' in args:
+			self._options['html-math-method'] = 'mathml'
+
+	def set_connection(self, connection):
+		# False if the job is already cancelled
+		with self._lock:
+			self._connection = connection
+			return not self._cancelled
+
+	def is_cancelled(self):
+		return self._cancelled
+
+	def cancel(self):
+		# A stale request is aborted, so the worker is free at once
+		with self._lock:
+			self._cancelled = True
+			connection = self._connection
+		if connection is not None and connection.sock is not None:
+			try:
+				connection.sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+		PandocJob.cancel(self)
+
+	def run(self):
+		if self._server.is_usable():
+			try:
+				start = time.monotonic()
+				result = self._server.convert(self.text, self._from_format, \
+					timeout=get_limits()[0], job=self, options=self._options)
+				self.timings['pandoc'] = time.monotonic() - start
+				return None if self._cancelled else result
+			except ServerError:
+				pass
+		return PandocJob.run(self)
+
+################################################################################
+# A single server is shared by all the windows of the gedit instance.
+
+_shared_server = None
+_shared_users = 0
+_shared_lock = threading.Lock()
+
+def acquire_server():
+	global _shared_server, _shared_users
+	with _shared_lock:
+		if _shared_server is None:
+			_shared_server = PandocServer()
+		_shared_users = _shared_users + 1
+		return _shared_server
+
+def release_server():
+	global _shared_server, _shared_users
+	with _shared_lock:
+		_shared_users = _shared_users - 1
+		if _shared_users > 0 or _shared_server is None:
+			return
+		server = _shared_server
+		_shared_server = None
+	server.stop()
+
+def _stop_at_exit():
+	if _shared_server is not None:
+		_shared_server.stop()
+
+atexit.register(_stop_at_exit)
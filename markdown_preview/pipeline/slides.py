@@ -0,0 +1,61 @@
+import re
+
+# Slideshow mode: the source is cut into slides at its horizontal rules, so only
+# the visible slide has to be converted.
+
+FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+RULE_RE = re.compile(r'^ {0,3}([-*_])( *\1){2,} *$')
+HTML_RULE_RE = re.compile(r'<hr\s*/?>', re.IGNORECASE)
+# A YAML metadata block at the top of the document, whose rules aren't breaks
+METADATA_RE = re.compile(r'\A---[ \t]*\r?\n(?![ \t]*\r?\n)(?:.*\r?\n)*?(?:---|\.\.\.)[ \t]*(?:\r?\n|\Z)')
+
+class SlideIndex:
+	# Offsets of the rules in the source, computed once per revision of the text.
+
+	def __init__(self, text, from_format):
+		self.text = text
+		self.format = from_format
+		if from_format == 'html':
+			self.bounds = self._find_html_rules(text)
+		else:
+			self.bounds = self._find_markdown_rules(text)
+
+	def get_count(self):
+		return len(self.bounds) + 1
+
+	def clamp(self, index):
+		return max(0, min(index, self.get_count() - 1))
+
+	def get_slide(self, index):
+		index = self.clamp(index)
+		start = 0 if index == 0 else self.bounds[index - 1][1]
+		end = len(self.text) if index == len(self.bounds) else self.bounds[index][0]
+		return self.text[start:end]
+
+	def _find_html_rules(self, text):
+		return [(m.start(), m.end()) for m in HTML_RULE_RE.finditer(text)]
+
+	def _find_markdown_rules(self, text):
+		bounds = []
+		fence = None
+		previous_blank = True
+		metadata = METADATA_RE.match(text)
+		offset = 0 if metadata is None else metadata.end()
+		for line in text[offset:].splitlines(True):
+			stripped = line.rstrip('\r\n')
+			if fence is not None:
+				if stripped.strip().startswith(fence):
+					fence = None
+			elif FENCE_RE.match(stripped):
+				fence = FENCE_RE.match(stripped).group(1)
+			elif previous_blank and RULE_RE.match(stripped):
+				# Right after a paragraph, '---' would underline a heading instead.
+				bounds.append((offset, offset + len(line)))
+			previous_blank = (stripped.strip() == '') or (len(bounds) > 0 and \
+			                                            bounds[-1][1] == offset + len(line))
+			offset = offset + len(line)
+		return bounds
+
+def split_html_pages(html_string):
+	# For formats which can't be indexed before conversion (LaTeX)
+	return HTML_RULE_RE.split(html_string)
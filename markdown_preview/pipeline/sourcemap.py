@@ -0,0 +1,144 @@
+# Source positions in the preview: elements carry the line of the source they
+# come from (data-source-line, counted from 1), and a script of the page keeps
+# them in a sorted index, so a line is converted to a scroll offset (and back)
+# with a binary search.
+
+from .blocks import locate_blocks
+
+# These blocks belong to their neighbour (captions, definitions, metadata), so
+# no marker is inserted before them.
+ATTACHED_PREFIXES = (':', '~', 'Table:', '---', '%')
+
+def find_blocks(text, block_texts):
+	# The position (-1 if not found) and line of each block of a LaTeX text.
+	# Their first lines are looked for in order, each after the previous one.
+	found_blocks = []
+	position = 0
+	line = 1
+	for block_text in block_texts:
+		first_line = block_text.split('\n', 1)[0]
+		found = text.find(first_line, position)
+		if found >= 0:
+			line = line + text.count('\n', position, found)
+			position = found + len(first_line)
+		found_blocks.append((found, line))
+	return found_blocks
+
+def get_block_lines(text, block_texts):
+	return [line for position, line in find_blocks(text, block_texts)]
+
+def build_marker(line):
+	return '<div class="mdp-line" data-source-line="' + str(line) + '"></div>'
+
+def add_line_markers(text):
+	# An empty div is inserted before each top-level block of a Markdown text,
+	# whatever the backend, since they both let raw html through.
+	parts = []
+	position = 0
+	previous = ''
+	for block_text, offset, line in locate_blocks(text):
+		first_line = block_text.lstrip()
+		if not first_line.startswith(ATTACHED_PREFIXES) and not previous.startswith('Table:'):
+			parts.append(text[position:offset])
+			parts.append(build_marker(line) + '\n\n')
+			position = offset
+		previous = first_line
+	parts.append(text[position:])
+	return ''.join(parts)
+
+SCROLL_SCRIPT = '''(function () {
+	var index = null;
+	var ignoreUntil = 0;
+	var pending = false;
+
+	function getTop(node) {
+		// Blocks patched in place are displayed as their contents
+		if (getComputedStyle(node).display === 'contents') {
+			node = node.firstElementChild;
+			if (!node) {
+				return null;
+			}
+		}
+		return node.getBoundingClientRect().top + window.scrollY;
+	}
+
+	function build() {
+		var nodes = document.querySelectorAll('[data-source-line]');
+		index = {lines: [], tops: []};
+		for (var i = 0; i < nodes.length; i++) {
+			var line = parseFloat(nodes[i].dataset.sourceLine);
+			var top = getTop(nodes[i]);
+			var last = index.lines.length - 1;
+			if (top === null || (last >= 0 && (line <= index.lines[last] || top < index.tops[last]))) {
+				continue;
+			}
+			index.lines.push(line);
+			index.tops.push(top);
+		}
+		return index;
+	}
+
+	function search(array, value) {
+		// The last position whose value is lower or equal, or -1
+		var low = 0, high = array.length - 1, found = -1;
+		while (low <= high) {
+			var middle = (low + high) >> 1;
+			if (array[middle] <= value) {
+				found = middle;
+				low = middle + 1;
+			} else {
+				high = middle - 1;
+			}
+		}
+		return found;
+	}
+
+	function interpolate(from, to, value) {
+		var i = search(from, value);
+		if (i < 0) {
+			return to[0] * Math.max(0, value) / Math.max(from[0], 1);
+		}
+		if (i === from.length - 1 || from[i + 1] === from[i]) {
+			return to[i];
+		}
+		return to[i] + (to[i + 1] - to[i]) * (value - from[i]) / (from[i + 1] - from[i]);
+	}
+
+	window.mdpInvalidate = function () {
+		index = null;
+	};
+
+	window.mdpScrollToLine = function (line) {
+		var current = index || build();
+		if (current.lines.length === 0) {
+			return;
+		}
+		ignoreUntil = Date.now() + 150;
+		window.scrollTo(window.scrollX, interpolate(current.lines, current.tops, line));
+	};
+
+	window.mdpLineAtScroll = function () {
+		var current = index || build();
+		if (current.lines.length === 0) {
+			return null;
+		}
+		return interpolate(current.tops, current.lines, window.scrollY);
+	};
+
+	window.addEventListener('scroll', function () {
+		if (pending || Date.now() < ignoreUntil) {
+			return;
+		}
+		pending = true;
+		window.requestAnimationFrame(function () {
+			pending = false;
+			var line = window.mdpLineAtScroll();
+			if (line !== null) {
+				window.webkit.messageHandlers.mdpScroll.postMessage(line);
+			}
+		});
+	});
+	window.addEventListener('resize', window.mdpInvalidate);
+	// Pictures change the offsets once loaded
+	document.addEventListener('load', window.mdpInvalidate, true);
+})();'''
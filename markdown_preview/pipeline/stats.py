@@ -0,0 +1,140 @@
+import collections
+import json
+import logging
+import sys
+import time
+
+# Timing of the render stages: where the time goes between an edit and the
+# updated preview.
+
+STAGES = ['read', 'queue', 'fragments', 'pandoc', 'decode', 'convert', 'cache', 'wrap', 'images', 'bytes', \
+	'webkit']
+# Upper bounds (ms) of the histogram buckets
+BUCKETS = [1, 4, 16, 64, 256, 1024, float('inf')]
+
+class RenderTrace:
+	# The stages of a single render. mark() attributes the time elapsed since
+	# the previous mark to a stage; add() records a duration measured elsewhere.
+
+	def __init__(self, doc_name, doc_format, key=None):
+		self.doc_name = doc_name
+		self.doc_format = doc_format
+		self.key = key
+		self.stages = collections.OrderedDict()
+		self.start = time.monotonic()
+		self._last = self.start
+
+	def mark(self, stage):
+		now = time.monotonic()
+		self.add(stage, now - self._last)
+		self._last = now
+
+	def add(self, stage, seconds):
+		self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+	def skip(self):
+		# Time spent elsewhere (e.g. on the worker thread) isn't attributed again
+		self._last = time.monotonic()
+
+	def get_total(self):
+		return sum(self.stages.values())
+
+	def to_dict(self):
+		return {
+			'document': self.doc_name,
+			'format': self.doc_format,
+			'total_ms': round(self.get_total() * 1000, 3),
+			'stages_ms': dict((k, round(v * 1000, 3)) for k, v in self.stages.items()),
+		}
+
+class StageHistogram:
+	# Rolling window of the last durations of each stage
+
+	def __init__(self, size=100):
+		self._samples = collections.defaultdict(lambda: collections.deque(maxlen=size))
+
+	def record(self, trace):
+		for stage, seconds in trace.stages.items():
+			self._samples[stage].append(seconds * 1000)
+		self._samples['total'].append(trace.get_total() * 1000)
+
+	def get_stages(self):
+		known = [s for s in STAGES if s in self._samples]
+		return known + [s for s in self._samples if s not in STAGES]
+
+	def get_summary(self, stage):
+		samples = sorted(self._samples[stage])
+		if len(samples) == 0:
+			return None
+		counts = [0] * len(BUCKETS)
+		for value in samples:
+			for i, bound in enumerate(BUCKETS):
+				if value < bound:
+					counts[i] = counts[i] + 1
+					break
+		return {
+			'count': len(samples),
+			'last': self._samples[stage][-1],
+			'p50': samples[len(samples) // 2],
+			'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+			'buckets': counts,
+		}
+
+class RenderStats:
+	# One histogram per document, for the most recently rendered documents
+
+	MAX_DOCUMENTS = 20
+
+	def __init__(self):
+		self._histograms = collections.OrderedDict()
+		# Renders stopped by the time or memory limits
+		self.timeouts = 0
+
+	def record(self, key, trace):
+		if key not in self._histograms:
+			self._histograms[key] = StageHistogram()
+			if len(self._histograms) > self.MAX_DOCUMENTS:
+				self._histograms.popitem(last=False)
+		self._histograms.move_to_end(key)
+		self._histograms[key].record(trace)
+
+	def get_histogram(self, key):
+		return self._histograms.get(key)
+
+	def forget(self, key):
+		self._histograms.pop(key, None)
+
+SPARKS = ' ▁▂▃▄▅▆▇█'
+
+def format_histogram(histogram):
+	# A small text table, for the stats popover. Durations are in ms, and the
+	# last column shows the distribution over BUCKETS (<1 ms to >1 s).
+	lines = ['%-8s %6s %8s %8s %8s  %s' % ('stage', 'n', 'last', 'p50', 'p95', 'histogram')]
+	for stage in histogram.get_stages():
+		summary = histogram.get_summary(stage)
+		top = max(summary['buckets'])
+		bars = ''.join(SPARKS[(len(SPARKS) - 1) * count // top] for count in summary['buckets'])
+		lines.append('%-8s %6d %8.1f %8.1f %8.1f  %s' % (stage, summary['count'], \
+			summary['last'], summary['p50'], summary['p95'], bars))
+	return '\n'.join(lines)
+
+################################################################################
+# Structured debug logging: one JSON object per render, on stderr
+
+_logger = None
+
+def get_logger():
+	global _logger
+	if _logger is None:
+		_logger = logging.getLogger('markdown_preview')
+		_logger.setLevel(logging.DEBUG)
+		_logger.propagate = False
+		handler = logging.StreamHandler(sys.stderr)
+		handler.setFormatter(logging.Formatter('markdown_preview: %(message)s'))
+		_logger.addHandler(handler)
+	return _logger
+
+def log_trace(trace, **extra):
+	record = trace.to_dict()
+	record.update(extra)
+	get_logger().debug(json.dumps(record, sort_keys=True))
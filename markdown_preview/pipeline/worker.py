@@ -0,0 +1,183 @@
+import re
+import subprocess
+import threading
+import time
+
+# Limits of the pandoc processes started by the current thread: they're set by
+# the render workers, so exports and batch renders run without any.
+_limits = threading.local()
+
+def get_limits():
+	# (wall-clock timeout in s, memory limit in bytes), None for no limit
+	return getattr(_limits, 'timeout', None), getattr(_limits, 'memory', None)
+
+def set_limits(timeout, memory):
+	_limits.timeout = timeout
+	_limits.memory = memory
+
+def get_memory_args(memory):
+	# The heap limit of pandoc's own runtime: nothing has to run in the child
+	# process before pandoc (which isn't safe with threads).
+	if memory is None:
+		return []
+	return ['+RTS', '-M' + str(max(1, memory // (1024 * 1024))) + 'm', '-RTS']
+
+class RenderLimitExceeded(RuntimeError):
+	# A conversion stopped because it took too long ('time') or too much
+	# memory ('memory').
+
+	def __init__(self, reason):
+		RuntimeError.__init__(self, 'render stopped: ' + reason + ' limit exceeded')
+		self.reason = reason
+
+# What the Haskell runtime says when it can't allocate more
+OUT_OF_MEMORY_RE = re.compile(rb'out of memory|heap exhausted|cannot allocate', re.IGNORECASE)
+
+class PandocJob:
+	# A single pandoc conversion. It runs on the worker thread, and can be killed
+	# from the main thread if its result isn't wanted anymore.
+
+	# Number of pandoc processes started, for benchmarks and statistics
+	spawned = 0
+
+	def __init__(self, args, text=None):
+		self.args = args
+		self.text = text
+		self.result = None
+		self.error = None
+		self.elapsed = 0
+		self.timings = {}
+		self._process = None
+		self._cancelled = False
+		self._lock = threading.Lock()
+
+	def run(self):
+		start = time.monotonic()
+		timeout, memory = get_limits()
+		with self._lock:
+			if self._cancelled:
+				return None
+			self._process = subprocess.Popen(['pandoc'] + get_memory_args(memory) + self.args, \
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			PandocJob.spawned = PandocJob.spawned + 1
+		data = None if self.text is None else self.text.encode('utf-8')
+		try:
+			stdout, stderr = self._process.communicate(data, timeout)
+		except subprocess.TimeoutExpired:
+			self._process.kill()
+			self._process.communicate()
+			if self._cancelled:
+				return None
+			raise RenderLimitExceeded('time')
+		if self._cancelled:
+			return None
+		if self._process.returncode != 0:
+			if memory is not None and (self._process.returncode < 0 or \
+			                           OUT_OF_MEMORY_RE.search(stderr)):
+				raise RenderLimitExceeded('memory')
+			raise RuntimeError(stderr.decode('utf-8', 'replace'))
+		converted = time.monotonic()
+		result = stdout.decode('utf-8')
+		self.timings['pandoc'] = converted - start
+		self.timings['decode'] = time.monotonic() - converted
+		return result
+
+	def cancel(self):
+		with self._lock:
+			self._cancelled = True
+			if self._process is not None and self._process.poll() is None:
+				self._process.kill()
+
+class JobSequence:
+	# Several jobs run one after the other on the same thread, e.g. to prepare
+	# results which aren't displayed yet. Failures are reported as None results.
+
+	def __init__(self, jobs):
+		self.jobs = jobs
+		self.result = None
+		self.error = None
+		self.elapsed = 0
+		self.timings = {}
+		self._cancelled = False
+
+	def run(self):
+		results = []
+		for job in self.jobs:
+			if self._cancelled:
+				return None
+			try:
+				results.append(job.run())
+			except Exception:
+				results.append(None)
+		return results
+
+	def cancel(self):
+		self._cancelled = True
+		for job in self.jobs:
+			job.cancel()
+
+class RenderWorker:
+	# Runs jobs on a background thread, one at a time. While a job is running,
+	# only the most recent request is kept: older pending ones are replaced, and
+	# the result of a job is dropped if a newer request has been submitted since.
+	# `dispatch` has to call its arguments on the main loop (e.g. GLib.idle_add).
+
+	def __init__(self, dispatch):
+		self._dispatch = dispatch
+		self._lock = threading.Lock()
+		self._revision = 0
+		self._current = None
+		self._pending = None
+		self.timeout = None
+		self.memory = None
+
+	def set_limits(self, timeout, memory):
+		# The pandoc processes of the next jobs are killed past these limits (s,
+		# bytes, or None), and the jobs fail with RenderLimitExceeded.
+		self.timeout = timeout
+		self.memory = memory
+
+	def submit(self, job, callback):
+		with self._lock:
+			self._revision = self._revision + 1
+			request = (self._revision, job, callback)
+			if self._current is not None:
+				self._pending = request
+				return
+			self._current = request
+		thread = threading.Thread(target=self._run, args=(request,), daemon=True)
+		thread.start()
+
+	def cancel(self):
+		with self._lock:
+			self._revision = self._revision + 1
+			self._pending = None
+			if self._current is not None:
+				self._current[1].cancel()
+
+	def is_busy(self):
+		return self._current is not None
+
+	def _run(self, request):
+		while request is not None:
+			revision, job, callback = request
+			start = time.monotonic()
+			set_limits(self.timeout, self.memory)
+			try:
+				job.result = job.run()
+			except Exception as e:
+				job.error = e
+			job.elapsed = time.monotonic() - start
+			with self._lock:
+				stale = (revision != self._revision)
+				request = self._pending
+				self._pending = None
+				self._current = request
+			if not stale:
+				self._dispatch(self._deliver, revision, job, callback)
+
+	def _deliver(self, revision, job, callback):
+		# Called on the main loop: a newer request may have arrived in the meantime.
+		if revision == self._revision:
+			callback(job)
+		return False
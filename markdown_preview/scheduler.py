@@ -0,0 +1,56 @@
+import collections
+from gi.repository import GLib
+
+class RenderScheduler:
+	# Debounces render requests coming from buffer edits. The delay adapts to how
+	# long the last renders took: small files are refreshed almost instantly, huge
+	# ones only when the typing pauses.
+
+	MIN_DELAY = 20 # ms
+	MAX_DELAY = 2000 # ms
+	DELAY_FACTOR = 1.5
+
+	def __init__(self, callback):
+		self._callback = callback
+		self._timeout_id = 0
+		self._durations = collections.deque(maxlen=8)
+		self.requested = 0
+		self.coalesced = 0
+		self.executed = 0
+
+	def request(self):
+		self.requested = self.requested + 1
+		if self._timeout_id != 0:
+			# The previous request hasn't run yet, this one replaces it.
+			GLib.source_remove(self._timeout_id)
+			self.coalesced = self.coalesced + 1
+		self._timeout_id = GLib.timeout_add(self.get_delay(), self._on_timeout)
+
+	def cancel(self):
+		if self._timeout_id != 0:
+			GLib.source_remove(self._timeout_id)
+			self._timeout_id = 0
+
+	def add_duration(self, seconds):
+		self._durations.append(seconds * 1000)
+
+	def get_delay(self):
+		if len(self._durations) == 0:
+			return self.MIN_DELAY
+		average = sum(self._durations) / len(self._durations)
+		delay = int(average * self.DELAY_FACTOR)
+		return max(self.MIN_DELAY, min(delay, self.MAX_DELAY))
+
+	def get_stats(self):
+		return {
+			'requested': self.requested,
+			'coalesced': self.coalesced,
+			'executed': self.executed,
+			'delay': self.get_delay(),
+		}
+
+	def _on_timeout(self):
+		self._timeout_id = 0
+		self.executed = self.executed + 1
+		self._callback()
+		return False
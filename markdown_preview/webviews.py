@@ -0,0 +1,239 @@
+import collections
+import os
+from gi.repository import Gio
+
+################################################################################
+# All the previews of the gedit instance share one web context (so one cache
+# and, as far as WebKit allows it, one web process) and one set of settings.
+# WebKit2 is imported by these functions, so it's only loaded when needed.
+
+_web_context = None
+_web_settings = None
+_web_process_started = False
+
+def get_web_context():
+	from gi.repository import WebKit2
+	global _web_context
+	if _web_context is None:
+		_web_context = WebKit2.WebContext.new()
+		_web_context.set_cache_model(WebKit2.CacheModel.DOCUMENT_VIEWER)
+		if hasattr(_web_context, 'set_process_model'): # deprecated since 2.26
+			_web_context.set_process_model(WebKit2.ProcessModel.SHARED_SECONDARY_PROCESS)
+	return _web_context
+
+def set_jit_option(gsettings):
+	# JavaScriptCore reads its options from the environment of each web
+	# process, and since WebKit 2.26 every view has its own process. So the
+	# option is set once, when the plugin is loaded: before any web process
+	# is started, and before any thread which could start pandoc.
+	if not gsettings.get_boolean('webkit-jit') and 'JSC_useJIT' not in os.environ:
+		os.environ['JSC_useJIT'] = 'false'
+
+def prewarm():
+	# Starts a web process before it's needed, e.g. while the document is
+	# loaded and converted.
+	global _web_process_started
+	if _web_process_started:
+		return
+	_web_process_started = True
+	context = get_web_context()
+	if hasattr(context, 'prewarm'): # before 2.24, the process starts with the first page
+		context.prewarm()
+
+def get_web_settings(gsettings):
+	from gi.repository import WebKit2
+	global _web_settings
+	if _web_settings is None:
+		_web_settings = WebKit2.Settings()
+	_web_settings.set_enable_plugins(gsettings.get_boolean('webkit-plugins'))
+	_web_settings.set_enable_page_cache(gsettings.get_boolean('webkit-page-cache'))
+	_web_settings.set_enable_java(False)
+	_web_settings.set_enable_webgl(False)
+	return _web_settings
+
+def create_web_view(gsettings):
+	# Each view has its own content manager, since a stylesheet only applies
+	# to some documents.
+	from gi.repository import WebKit2
+	settings = get_web_settings(gsettings)
+	prewarm()
+	return WebKit2.WebView(web_context=get_web_context(), settings=settings, \
+		user_content_manager=WebKit2.UserContentManager())
+
+class StyleSheetWatcher:
+	# The user's stylesheet, loaded once as a WebKit user stylesheet and watched:
+	# when the file changes, `callback` is called to swap it in the displayed
+	# pages, which aren't rendered again.
+
+	def __init__(self, callback):
+		self._callback = callback
+		self._monitor = None
+		self._handler = None
+		self._file = None
+		self.sheet = None
+
+	def set_path(self, path):
+		self.stop()
+		self.sheet = None
+		if path == '':
+			self._callback()
+			return
+		self._file = Gio.File.new_for_commandline_arg(path)
+		self._monitor = self._file.monitor_file(Gio.FileMonitorFlags.WATCH_MOVES, None)
+		self._handler = self._monitor.connect('changed', self._on_file_changed)
+		self._load()
+
+	def stop(self):
+		if self._monitor is not None:
+			self._monitor.disconnect(self._handler)
+			self._monitor.cancel()
+		self._monitor = None
+
+	def _on_file_changed(self, monitor, file, other_file, event):
+		# Editors write files in several steps, the last one is signaled with a hint
+		if event in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED, \
+		             Gio.FileMonitorEvent.RENAMED, Gio.FileMonitorEvent.MOVED_IN):
+			self._load()
+
+	def _load(self):
+		self._file.load_contents_async(None, self._on_loaded, self._file)
+
+	def _on_loaded(self, source, result, requested_file):
+		from gi.repository import WebKit2
+		if requested_file is not self._file:
+			return # the setting has changed in the meantime
+		try:
+			success, contents, etag = source.load_contents_finish(result)
+		except Exception:
+			return
+		self.sheet = WebKit2.UserStyleSheet(contents.decode('utf-8', 'replace'), \
+			WebKit2.UserContentInjectedFrames.ALL_FRAMES, WebKit2.UserStyleLevel.AUTHOR, \
+			None, None)
+		self._callback()
+
+################################################################################
+
+class PooledView:
+	# A live WebView and what's known about the page it displays
+
+	def __init__(self, view):
+		self.view = view
+		self.key = None
+		self.size = 0
+		self.html = None
+		self.text_index = None
+		self.anchor_line = None
+		self.displayed_blocks = None
+		self.displayed_context = None
+		self.styled = False
+		self.style_sheet = None
+		self.image_width = None # the pictures of the page are scaled to
+
+class WebViewPool:
+	# Keeps one WebView per recently used document in a Gtk.Stack, so switching
+	# back to a tab doesn't cost a render. The least recently used views are
+	# destroyed when there are more than `max_views` of them, or when their
+	# estimated memory use is above `max_bytes`; their scroll offset is kept.
+	# With max_views = 1, a single view is shared by all documents.
+
+	BASE_COST = 4 * 1024 * 1024 # a web view without content
+	BYTES_FACTOR = 10 # memory used for each byte of html, roughly
+
+	def __init__(self, stack, create_view, max_views=1, max_bytes=0):
+		self._stack = stack
+		self._create_view = create_view
+		self._entries = collections.OrderedDict()
+		self._scroll = {}
+		self.max_views = max_views
+		self.max_bytes = max_bytes
+
+	def acquire(self, doc):
+		if doc in self._entries:
+			self._entries.move_to_end(doc)
+			return self._entries[doc]
+		if None in self._entries:
+			# A view whose document has been closed
+			entry = self._entries.pop(None)
+		elif self.max_views <= 1 and len(self._entries) > 0:
+			# The only view changes hands, and is emptied
+			old_doc, entry = self._entries.popitem()
+			self._save_scroll(old_doc, entry.view, False)
+			entry.key = None
+			entry.html = None
+			entry.text_index = None
+			entry.anchor_line = None
+			entry.displayed_blocks = None
+		else:
+			entry = PooledView(self._create_view())
+			self._stack.add(entry.view)
+			entry.view.show()
+		self._entries[doc] = entry
+		if doc in self._scroll:
+			self._restore_scroll(entry.view, self._scroll.pop(doc))
+		self._evict()
+		return entry
+
+	def set_content(self, doc, key, html):
+		# The search index of the previous content is outdated
+		entry = self._entries.get(doc)
+		if entry is None:
+			return
+		entry.key = key
+		entry.html = html
+		entry.text_index = None
+		entry.size = self.BASE_COST + len(html) * self.BYTES_FACTOR
+		self._evict()
+
+	def remove(self, doc):
+		entry = self._entries.pop(doc, None)
+		self._scroll.pop(doc, None)
+		if entry is None:
+			return
+		if entry.view is self._stack.get_visible_child() or len(self._entries) == 0:
+			# Still displayed: it's kept for the next document
+			previous = self._entries.pop(None, None)
+			if previous is not None:
+				previous.view.destroy()
+			entry.key = None
+			entry.html = None
+			entry.text_index = None
+			entry.anchor_line = None
+			entry.displayed_blocks = None
+			self._entries[None] = entry
+		else:
+			entry.view.destroy()
+
+	def get_entries(self):
+		return list(self._entries.values())
+
+	def get_size(self):
+		return sum(entry.size for entry in self._entries.values())
+
+	def _evict(self):
+		# The most recent view is the one displayed, it's never evicted.
+		while len(self._entries) > 1 and (len(self._entries) > self.max_views \
+		                                          or self.get_size() > self.max_bytes):
+			doc, entry = self._entries.popitem(last=False)
+			self._save_scroll(doc, entry.view, True)
+
+	def _save_scroll(self, doc, view, destroy):
+		view.run_javascript('window.scrollY', None, self._on_scroll_read, (doc, destroy))
+
+	def _on_scroll_read(self, view, result, data):
+		doc, destroy = data
+		try:
+			value = view.run_javascript_finish(result).get_js_value().to_double()
+			if doc is not None:
+				self._scroll[doc] = value
+		except Exception:
+			pass
+		if destroy:
+			view.destroy()
+
+	def _restore_scroll(self, view, value):
+		# Once the next page is loaded
+		def on_load_changed(view, event):
+			if event.value_nick == 'finished':
+				view.disconnect(handler)
+				view.run_javascript('window.scrollTo(0, %d);' % value, None, None, None)
+		handler = view.connect('load-changed', on_load_changed)
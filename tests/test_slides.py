@@ -0,0 +1,23 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'markdown_preview'))
+
+from pipeline.slides import SlideIndex
+
+class SlideIndexTest(unittest.TestCase):
+
+	def test_rules_split_slides(self):
+		index = SlideIndex('# One\n\n---\n\n# Two\n\nText\n---\n', 'markdown')
+		# The last '---' underlines a heading
+		self.assertEqual(index.get_count(), 2)
+		self.assertEqual(index.get_slide(1), '\n# Two\n\nText\n---\n')
+
+	def test_metadata_block_isnt_a_break(self):
+		index = SlideIndex('---\ntitle: My deck\n---\n\n# Slide 1\n\n---\n\n# Slide 2\n', 'markdown')
+		self.assertEqual(index.get_count(), 2)
+		self.assertEqual(index.get_slide(0), '---\ntitle: My deck\n---\n\n# Slide 1\n\n')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'markdown_preview'))
+
+from pipeline.blocks import locate_blocks, split_blocks
+from pipeline.sourcemap import add_line_markers, build_marker
+
+class SplitBlocksTest(unittest.TestCase):
+
+	def test_paragraphs(self):
+		text = 'First\nparagraph\n\n\nSecond\n'
+		self.assertEqual(split_blocks(text), ['First\nparagraph', 'Second'])
+		self.assertEqual(locate_blocks(text), [('First\nparagraph', 0, 1), ('Second', 18, 5)])
+
+	def test_fence_keeps_blank_lines(self):
+		text = 'Code:\n\n```\na\n\nb\n```\n\nAfter'
+		self.assertEqual(split_blocks(text), ['Code:', '```\na\n\nb\n```', 'After'])
+		self.assertEqual([line for block_text, offset, line in locate_blocks(text)], [1, 3, 9])
+
+	def test_list_and_indented_blocks_are_merged(self):
+		text = '- one\n\n- two\n\n    more\n\nEnd'
+		self.assertEqual(split_blocks(text), ['- one\n\n- two\n\n    more', 'End'])
+		self.assertEqual(locate_blocks(text)[1], ('End', 24, 7))
+
+	def test_offsets_point_to_first_lines(self):
+		text = 'Use a Notebook for this\nand more text.\n\nNote\n\nNote again'
+		for block_text, offset, line in locate_blocks(text):
+			self.assertTrue(text.startswith(block_text, offset))
+			self.assertEqual(text.count('\n', 0, offset) + 1, line)
+
+class AddLineMarkersTest(unittest.TestCase):
+
+	def test_markers_before_blocks(self):
+		text = 'Para\n\n# Title\n'
+		self.assertEqual(add_line_markers(text), build_marker(1) + '\n\nPara\n\n' + \
+			build_marker(3) + '\n\n# Title\n')
+
+	def test_repeated_first_line_doesnt_split_a_paragraph(self):
+		text = 'Use a Notebook for this\nand more text.\n\nNote\n'
+		self.assertEqual(add_line_markers(text), build_marker(1) + '\n\n' + \
+			'Use a Notebook for this\nand more text.\n\n' + build_marker(4) + '\n\nNote\n')
+
+	def test_attached_blocks_have_no_marker(self):
+		# A caption, and the table it may come before
+		text = '| a |\n|---|\n| 1 |\n\nTable: caption\n\n| b |\n|---|\n\nAfter'
+		self.assertEqual(add_line_markers(text), build_marker(1) + '\n\n' + \
+			'| a |\n|---|\n| 1 |\n\nTable: caption\n\n| b |\n|---|\n\n' + build_marker(10) + \
+			'\n\nAfter')
+
+	def test_text_is_kept(self):
+		text = 'a\n\n```\nx\n\n```\n\n- b\n\n  c\n'
+		marked = add_line_markers(text)
+		for line in range(1, 10):
+			marked = marked.replace(build_marker(line) + '\n\n', '')
+		self.assertEqual(marked, text)
+
+if __name__ == '__main__':
+	unittest.main()